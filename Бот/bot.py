@@ -1,13 +1,23 @@
 """Telegram бот для суммаризации сообщений из базы данных."""
 
 import os
+import sys
 import logging
-import requests
-from datetime import datetime
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 import telebot
 
 from database import Database
+from scheduler import DIGEST_INTERVALS, SummaryScheduler
+
+# Общий клиент OpenRouter, кэш и map-reduce лежат в папке «Интенсив AI»
+# (их же использует CLI)
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Интенсив AI"))
+from openrouter import OpenRouterClient  # noqa: E402
+from summarizer import map_reduce_summarize  # noqa: E402
+from summary_cache import SummaryCache, cache_key  # noqa: E402
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -18,6 +28,17 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct")
+# Бюджет токенов на один запрос и число параллельных запросов при map-reduce
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+SUMMARY_MAX_WORKERS = int(os.getenv("SUMMARY_MAX_WORKERS", "4"))
+# Как часто (в секундах) обновлять сообщение при потоковой выдаче выжимки;
+# Telegram ограничивает частоту редактирования сообщений
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Фоновые задачи: число рабочих потоков и период проверки расписания дайджестов
+SUMMARY_JOB_WORKERS = int(os.getenv("SUMMARY_JOB_WORKERS", "2"))
+DIGEST_TICK_SECONDS = float(os.getenv("DIGEST_TICK_SECONDS", "30"))
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN is not set")
@@ -25,60 +46,134 @@ if not OPENROUTER_API_KEY:
     raise RuntimeError("OPENROUTER_API_KEY is not set")
 
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
-db = Database()
+# Входящие сообщения пишутся пачками в фоновом потоке, чтобы обработчик
+# не ждал fsync на каждое сообщение (DB_WRITE_BEHIND=0 — писать сразу)
+db = Database(write_behind=os.getenv("DB_WRITE_BEHIND", "1") != "0")
+# Один клиент на процесс: keep-alive соединения переиспользуются между запросами
+openrouter = OpenRouterClient(
+    OPENROUTER_API_KEY,
+    model=OPENROUTER_MODEL,
+    referer=os.getenv("OPENROUTER_REFERRER", "https://t.me"),
+    title=os.getenv("OPENROUTER_TITLE", "TelegramBot"),
+    pool_size=max(SUMMARY_MAX_WORKERS, 4),
+)
+# Кэш выжимок на диске (общий с CLI): повторные запросы не уходят в API
+summary_cache = (
+    None if os.getenv("SUMMARY_CACHE", "1") == "0" else SummaryCache()
+)
+
+
+# Инструкция для суммаризации с ограничением в 5 предложений
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты помощник для создания кратких выжимок текста. "
+    "Создай краткую суммаризацию текста, выделяя самое главное. "
+    "Ответ должен содержать максимум 5 предложений. "
+    "Будь точным и лаконичным."
+)
+FINAL_PROMPT = "Суммаризируй следующий текст (максимум 5 предложений):\n\n"
+CHUNK_PROMPT = (
+    "Это фрагмент длинной переписки. Кратко перескажи его, сохранив "
+    "важные факты, решения, договорённости и имена:\n\n"
+)
 
 
-def summarize_text(text: str) -> str:
-    """Суммаризировать текст через OpenRouter, максимум 5 предложений.
+def request_summary(user_prompt: str) -> str:
+    """Отправить запрос в OpenRouter и вернуть ответ модели.
     
-    Args:
-        text: Текст для суммаризации
-        
-    Returns:
-        Суммаризированный текст (максимум 5 предложений)
+    Одинаковые запросы (та же модель, промпт и текст) берутся из кэша.
+    
+    Raises:
+        OpenRouterError: Ошибка сети, HTTP-статус ошибки или пустой ответ.
     """
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": os.getenv("OPENROUTER_REFERRER", "https://t.me"),
-        "X-Title": os.getenv("OPENROUTER_TITLE", "TelegramBot"),
-    }
-    
-    # Инструкция для суммаризации с ограничением в 5 предложений
-    system_prompt = (
-        "Ты помощник для создания кратких выжимок текста. "
-        "Создай краткую суммаризацию текста, выделяя самое главное. "
-        "Ответ должен содержать максимум 5 предложений. "
-        "Будь точным и лаконичным."
+    if summary_cache is None:
+        return openrouter.complete(SUMMARY_SYSTEM_PROMPT, user_prompt)
+    return summary_cache.get_or_create(
+        OPENROUTER_MODEL,
+        SUMMARY_SYSTEM_PROMPT,
+        user_prompt,
+        lambda: openrouter.complete(SUMMARY_SYSTEM_PROMPT, user_prompt),
     )
+
+
+def stream_request_summary(
+    user_prompt: str, on_partial: Callable[[str], None]
+) -> str:
+    """Как request_summary, но получать ответ потоком.
     
-    user_prompt = f"Суммаризируй следующий текст (максимум 5 предложений):\n\n{text}"
+    on_partial вызывается с накопленным текстом после каждого фрагмента.
+    Ответ из кэша возвращается сразу, без вызова on_partial.
+    """
+    key = cache_key(OPENROUTER_MODEL, SUMMARY_SYSTEM_PROMPT, user_prompt)
+    if summary_cache is not None:
+        cached = summary_cache.get(key)
+        if cached is not None:
+            return cached
     
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-    }
+    text = ""
+    for piece in openrouter.stream_complete(SUMMARY_SYSTEM_PROMPT, user_prompt):
+        text += piece
+        on_partial(text)
+    text = text.strip()
+    if summary_cache is not None:
+        summary_cache.put(key, text)
+    return text
 
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=60)
-        if resp.status_code == 429:
-            return "Ошибка: превышен лимит запросов. Подожди немного и попробуй снова."
-        resp.raise_for_status()
-        data = resp.json()
-        choices = data.get("choices", [])
-        if not choices:
-            raise ValueError(f"OpenRouter вернул пустой ответ: {data}")
-        content = choices[0].get("message", {}).get("content", "").strip()
-        if not content:
-            raise ValueError(f"OpenRouter вернул пустой ответ: {data}")
-        return content
-    except Exception as exc:
-        logger.exception("Ошибка при запросе к OpenRouter")
-        return f"Ошибка при суммаризации: {exc}"
+
+class ThrottledEditor:
+    """Постепенно обновлять сообщение бота, не чаще раза в interval секунд.
+    
+    Промежуточные версии отправляются без разметки (незакрытые * или _
+    сломали бы Markdown), ошибки редактирования только логируются.
+    """
+    
+    def __init__(
+        self, chat_id: int, message_id: int, header: str,
+        interval: float = STREAM_EDIT_INTERVAL,
+    ) -> None:
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.interval = interval
+        self._last_edit = 0.0
+        self._shown = ""
+    
+    def __call__(self, text: str) -> None:
+        now = time.monotonic()
+        if now - self._last_edit < self.interval or text == self._shown:
+            return
+        self._last_edit = now
+        self._shown = text
+        body = (self.header + text)[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+        try:
+            bot.edit_message_text(body, chat_id=self.chat_id, message_id=self.message_id)
+        except telebot.apihelper.ApiTelegramException as exc:
+            logger.warning("Не удалось обновить сообщение: %s", exc)
+
+
+def summarize_messages(
+    texts: List[str], on_partial: Optional[Callable[[str], None]] = None
+) -> str:
+    """Суммаризировать все сообщения целиком через map-reduce.
+    
+    Фрагменты по SUMMARY_CHUNK_TOKENS токенов суммаризируются параллельно
+    (до SUMMARY_MAX_WORKERS запросов сразу), затем частичные выжимки
+    сводятся в итоговую. Ошибки запросов пробрасываются.
+    
+    Если передан on_partial, итоговая выжимка запрашивается потоком и
+    on_partial получает её по мере генерации.
+    """
+    def combine(text: str) -> str:
+        if on_partial is None:
+            return request_summary(FINAL_PROMPT + text)
+        return stream_request_summary(FINAL_PROMPT + text, on_partial)
+    
+    return map_reduce_summarize(
+        texts,
+        lambda chunk: request_summary(CHUNK_PROMPT + chunk),
+        combine,
+        max_tokens=SUMMARY_CHUNK_TOKENS,
+        max_workers=SUMMARY_MAX_WORKERS,
+    )
 
 
 @bot.message_handler(commands=["start", "help"])
@@ -88,7 +183,8 @@ def send_welcome(message: telebot.types.Message) -> None:
         "Привет! Я бот для суммаризации сообщений.\n\n"
         "Я сохраняю все входящие текстовые сообщения в базу данных.\n\n"
         "Команды:\n"
-        "/summarize - создать суммаризацию всех новых сообщений (максимум 5 предложений)\n"
+        "/summarize - создать суммаризацию новых сообщений этого чата (максимум 5 предложений)\n"
+        "/digest hourly|daily|off - периодический дайджест новых сообщений этого чата\n"
         "/stats - показать статистику сообщений\n"
         "/help - показать это сообщение"
     )
@@ -99,15 +195,14 @@ def send_welcome(message: telebot.types.Message) -> None:
 def show_stats(message: telebot.types.Message) -> None:
     """Показать статистику по сообщениям в БД."""
     try:
-        total = db.get_message_count(processed=None)
-        processed = db.get_message_count(processed=True)
-        unprocessed = db.get_message_count(processed=False)
+        stats = db.get_stats(chat_id=message.chat.id)
         
         stats_text = (
             f"📊 Статистика сообщений:\n\n"
-            f"Всего сообщений: {total}\n"
-            f"Обработано: {processed}\n"
-            f"Новых (необработанных): {unprocessed}"
+            f"Всего сообщений: {stats['total']}\n"
+            f"Обработано: {stats['processed']}\n"
+            f"Новых (необработанных): {stats['unprocessed']}\n"
+            f"В этом чате: {stats['chat_total']}"
         )
         bot.reply_to(message, stats_text)
     except Exception as exc:
@@ -115,73 +210,174 @@ def show_stats(message: telebot.types.Message) -> None:
         bot.reply_to(message, f"Ошибка при получении статистики: {exc}")
 
 
-@bot.message_handler(commands=["summarize"])
-def handle_summarize(message: telebot.types.Message) -> None:
-    """Создать суммаризацию всех новых (необработанных) сообщений."""
+def publish_summary(
+    chat_id: int,
+    message_id: int,
+    unprocessed: List[Tuple[int, int, str, str]],
+    title: str,
+) -> None:
+    """Суммаризировать новые сообщения чата и показать выжимку в message_id.
+    
+    Выжимка появляется по мере генерации; сообщения помечаются как
+    обработанные только после успеха.
+    """
+    # Объединяем все тексты сообщений
+    texts = []
+    for _, _, sender, text in unprocessed:
+        if text.strip():  # Игнорируем пустые сообщения
+            texts.append(f"[{sender}]: {text}")
+    # Сообщения отсортированы по id: всё до последнего помечается одним UPSERT
+    last_id = unprocessed[-1][1]
+    
+    if not texts:
+        db.mark_processed_up_to(chat_id, last_id)
+        bot.edit_message_text(
+            "Все новые сообщения пустые, нечего суммаризировать.",
+            chat_id=chat_id,
+            message_id=message_id
+        )
+        return
+    
+    # Выполняем суммаризацию всех сообщений (map-reduce, без обрезки);
+    # итоговая выжимка появляется в сообщении по мере генерации
+    editor = ThrottledEditor(
+        chat_id,
+        message_id,
+        f"📝 {title} (обработано сообщений: {len(unprocessed)}):\n\n",
+    )
+    summary = summarize_messages(texts, on_partial=editor)
+    
+    # Помечаем сообщения как обработанные только после успеха
+    db.mark_processed_up_to(chat_id, last_id)
+    
+    # Отправляем результат
+    result_text = f"📝 *{title}* (обработано сообщений: {len(unprocessed)}):\n\n{summary}"
     try:
-        # Получаем все необработанные сообщения
-        unprocessed = db.get_unprocessed_messages()
-        
-        if not unprocessed:
-            bot.reply_to(message, "Нет новых сообщений для суммаризации.")
-            return
-        
-        # Уведомляем пользователя о начале обработки
-        bot.send_chat_action(message.chat.id, "typing")
-        processing_msg = bot.reply_to(
-            message, 
-            f"Обрабатываю {len(unprocessed)} новых сообщений..."
+        bot.edit_message_text(
+            result_text,
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode="Markdown"
         )
-        
-        # Объединяем все тексты сообщений
-        texts = []
-        message_ids = []
-        for msg_id, sender, text in unprocessed:
-            message_ids.append(msg_id)
-            if text.strip():  # Игнорируем пустые сообщения
-                texts.append(f"[{sender}]: {text}")
-        
-        if not texts:
+    except telebot.apihelper.ApiTelegramException:
+        # Модель могла вернуть текст с несбалансированной разметкой
+        bot.edit_message_text(
+            editor.header + summary,
+            chat_id=chat_id,
+            message_id=message_id,
+        )
+    
+    logger.info(
+        "Выжимка (%s) для чата %d готова. Обработано сообщений: %d",
+        title.lower(), chat_id, len(unprocessed)
+    )
+
+
+def run_summary_job(job: Dict[str, Any]) -> None:
+    """Выполнить задачу из очереди (вызывается рабочими потоками планировщика).
+    
+    summarize — выжимка новых сообщений чата в ответ на /summarize,
+    digest — периодический дайджест новых сообщений чата.
+    """
+    chat_id = job["chat_id"]
+    unprocessed = db.get_unprocessed_messages(chat_id)
+    if job["kind"] == "digest":
+        if not unprocessed:
+            return  # Пустые дайджесты не отправляем
+        bot.send_chat_action(chat_id, "typing")
+        message_id = bot.send_message(
+            chat_id, f"🕒 Готовлю дайджест по {len(unprocessed)} новым сообщениям..."
+        ).message_id
+        title = "Дайджест"
+    else:
+        message_id = job["reply_message_id"]
+        title = "Суммаризация"
+        if not unprocessed:
             bot.edit_message_text(
-                "Все новые сообщения пустые, нечего суммаризировать.",
-                chat_id=message.chat.id,
-                message_id=processing_msg.message_id
+                "Нет новых сообщений для суммаризации.",
+                chat_id=chat_id,
+                message_id=message_id,
             )
             return
-        
-        # Объединяем все тексты
-        combined_text = "\n\n".join(texts)
-        
-        # Если текст слишком длинный, обрезаем его (лимит для API)
-        max_length = 50000  # Примерный лимит
-        if len(combined_text) > max_length:
-            combined_text = combined_text[:max_length] + "\n\n[...текст обрезан...]"
-        
-        # Выполняем суммаризацию
-        summary = summarize_text(combined_text)
-        
-        # Помечаем сообщения как обработанные
-        db.mark_messages_as_processed(message_ids)
-        
-        # Отправляем результат
-        result_text = f"📝 *Суммаризация* (обработано сообщений: {len(message_ids)}):\n\n{summary}"
+        bot.send_chat_action(chat_id, "typing")
         bot.edit_message_text(
-            result_text,
-            chat_id=message.chat.id,
-            message_id=processing_msg.message_id,
-            parse_mode="Markdown"
+            f"Обрабатываю {len(unprocessed)} новых сообщений...",
+            chat_id=chat_id,
+            message_id=message_id,
         )
-        
-        logger.info(
-            "Суммаризация завершена. Обработано сообщений: %d", 
-            len(message_ids)
+    
+    try:
+        publish_summary(chat_id, message_id, unprocessed, title)
+    except Exception as exc:
+        bot.edit_message_text(
+            f"Ошибка при создании суммаризации: {exc}",
+            chat_id=chat_id,
+            message_id=message_id,
         )
-        
+        raise
+
+
+scheduler = SummaryScheduler(
+    db,
+    run_summary_job,
+    workers=SUMMARY_JOB_WORKERS,
+    tick_interval=DIGEST_TICK_SECONDS,
+)
+
+
+@bot.message_handler(commands=["summarize"])
+def handle_summarize(message: telebot.types.Message) -> None:
+    """Поставить суммаризацию новых сообщений этого чата в очередь.
+    
+    Сама суммаризация выполняется в фоне (run_summary_job), поэтому бот
+    продолжает отвечать на другие команды.
+    """
+    try:
+        placeholder = bot.reply_to(message, "⏳ Суммаризация поставлена в очередь...")
+        job_id = db.enqueue_job(
+            message.chat.id, "summarize", reply_message_id=placeholder.message_id
+        )
+        if job_id is None:
+            bot.edit_message_text(
+                "Суммаризация для этого чата уже в очереди или выполняется.",
+                chat_id=message.chat.id,
+                message_id=placeholder.message_id,
+            )
+            return
+        scheduler.notify()
     except Exception as exc:
-        logger.exception("Ошибка при суммаризации")
+        logger.exception("Ошибка при постановке суммаризации в очередь")
         bot.reply_to(message, f"Ошибка при создании суммаризации: {exc}")
 
 
+@bot.message_handler(commands=["digest"])
+def handle_digest(message: telebot.types.Message) -> None:
+    """Включить (/digest hourly|daily) или выключить (/digest off) дайджест чата."""
+    usage = "Использование: /digest hourly | daily | off"
+    args = (message.text or "").split()[1:]
+    try:
+        if not args:
+            interval = db.get_digest_schedule(message.chat.id)
+            names = {seconds: name for name, seconds in DIGEST_INTERVALS.items()}
+            current = names.get(interval, f"каждые {interval} с") if interval else "выключен"
+            bot.reply_to(message, f"Дайджест: {current}\n{usage}")
+            return
+        
+        mode = args[0].lower()
+        if mode == "off":
+            db.set_digest_schedule(message.chat.id, None)
+            bot.reply_to(message, "Дайджест выключен.")
+        elif mode in DIGEST_INTERVALS:
+            db.set_digest_schedule(message.chat.id, DIGEST_INTERVALS[mode])
+            period = "час" if mode == "hourly" else "день"
+            bot.reply_to(message, f"Дайджест новых сообщений будет приходить раз в {period}.")
+        else:
+            bot.reply_to(message, usage)
+    except Exception as exc:
+        logger.exception("Ошибка при настройке дайджеста")
+        bot.reply_to(message, f"Ошибка при настройке дайджеста: {exc}")
+
+
 @bot.message_handler(func=lambda msg: True, content_types=["text"])
 def handle_text(message: telebot.types.Message) -> None:
     """Обработчик всех текстовых сообщений - сохраняет их в БД."""
@@ -194,17 +390,20 @@ def handle_text(message: telebot.types.Message) -> None:
         if not sender_name:
             sender_name = f"user_{message.from_user.id}"
         
-        date_str = datetime.fromtimestamp(message.date).isoformat()
-        
         saved = db.save_message(
             message_id=message.message_id,
             chat_id=message.chat.id,
             sender=sender_name,
             text=message.text or "",
-            date=date_str
+            ts=message.date
         )
         
-        if saved:
+        if saved is None:
+            logger.debug(
+                "Сообщение ID=%d поставлено в очередь на запись",
+                message.message_id
+            )
+        elif saved:
             logger.info(
                 "Сохранено новое сообщение ID=%d от %s в чат %d",
                 message.message_id,
@@ -227,4 +426,9 @@ def handle_text(message: telebot.types.Message) -> None:
 if __name__ == "__main__":
     logger.info("Бот запущен")
     logger.info("База данных: %s", db.db_path)
-    bot.infinity_polling()
+    scheduler.start()
+    try:
+        bot.infinity_polling()
+    finally:
+        scheduler.stop(timeout=5)
+        db.close()
@@ -1,137 +1,528 @@
 """Синхронный модуль для работы с базой данных сообщений."""
 
+import logging
+import queue
 import sqlite3
 import os
-from typing import List, Tuple, Optional
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Optional
 from pathlib import Path
 
+# Общие миграции схемы лежат в папке Интенсив (рядом с коллектором)
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Интенсив"))
+from dbconfig import (  # noqa: E402
+    BUSY_RETRY_DELAY,
+    BUSY_RETRY_MAX_DELAY,
+    WriteBehindError,
+    checkpoint,
+    connect,
+    is_busy,
+    resolve_db_path,
+)
+from schema import migrate  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Новое сообщение (новое, пока его id выше водяного знака чата);
+# дубликат по (chat_id, id) молча пропускается
+INSERT_MESSAGE_SQL = """
+    INSERT OR IGNORE INTO messages (id, chat_id, sender, text, ts)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+MessageRow = Tuple[int, int, str, str, int]
+
 
 class Database:
-    """Синхронный wrapper для работы с SQLite БД сообщений."""
+    """Синхронный wrapper для работы с SQLite БД сообщений.
+    
+    Держит одно долгоживущее соединение, общее для всех потоков бота; запросы к нему сериализуются блокировкой.
+    
+    С write_behind=True save_message только кладёт сообщение в
+    ограниченную очередь, а фоновый поток записывает накопившиеся
+    сообщения одной транзакцией — как только их набралось batch_size
+    или прошло flush_interval_ms, смотря что раньше. Пачка не теряется:
+    пока базу держит другой процесс, запись повторяется с паузами, а
+    сообщения, не записанные по другой причине, flush() и close()
+    выбрасывают в WriteBehindError.
+    """
 
-    def __init__(self, db_path: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        *,
+        write_behind: bool = False,
+        batch_size: int = 500,
+        flush_interval_ms: int = 200,
+        max_queue_size: int = 10_000,
+    ) -> None:
         """Инициализация БД.
         
         Args:
-            db_path: Путь к БД. По умолчанию используется БД из папки Интенсив.
+            db_path: Путь к БД. По умолчанию $MESSAGES_DB_PATH или БД из папки Интенсив.
+            write_behind: Писать входящие сообщения пачками в фоновом потоке.
+            batch_size: Максимум сообщений в одной транзакции.
+            flush_interval_ms: Как долго сообщение может ждать записи.
+            max_queue_size: Размер очереди; при переполнении save_message ждёт.
         """
-        if db_path is None:
-            # Путь к БД в папке Интенсив
-            db_path = r"C:\Users\maxfo\OneDrive\Рабочий стол\Интенсив\messages.db"
-        self.db_path = db_path
+        self.db_path = resolve_db_path(db_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._lock = threading.RLock()
+        self._conn = self._connect()
         self._ensure_schema()
+        
+        self._queue: Optional["queue.Queue[MessageRow]"] = None
+        self._writer: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Под этой блокировкой save_message кладёт в очередь, а close()
+        # ставит _closed: после него в очередь уже ничего не попадёт
+        self._enqueue_lock = threading.Lock()
+        self._closed = False
+        self._failed: List[MessageRow] = []
+        self._failure: Optional[BaseException] = None
+        if write_behind:
+            self._queue = queue.Queue(maxsize=max_queue_size)
+            self._writer = threading.Thread(
+                target=self._write_loop, name="db-writer", daemon=True
+            )
+            self._writer.start()
 
-    def _get_connection(self) -> sqlite3.Connection:
-        """Получить соединение с БД."""
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть соединение, которым пользуются все потоки.
+
+        WAL, busy_timeout и политика checkpoint — общие с коллектором
+        и дашбордом (dbconfig).
+        """
+        conn = connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA temp_store=MEMORY;")
         return conn
 
+    @contextmanager
+    def _locked(self) -> Iterator[sqlite3.Connection]:
+        """Захватить общее соединение; незавершённая транзакция откатывается."""
+        with self._lock:
+            try:
+                yield self._conn
+            except BaseException:
+                if self._conn.in_transaction:
+                    self._conn.rollback()
+                raise
+
     def _ensure_schema(self) -> None:
-        """Убедиться, что схема БД актуальна (добавить поле processed если нужно)."""
-        conn = self._get_connection()
+        """Убедиться, что схема БД актуальна (применить недостающие миграции)."""
+        with self._locked() as conn:
+            migrate(conn)
+
+    def close(self) -> None:
+        """Дописать очередь и закрыть соединение.
+
+        Сначала очередь перестаёт принимать сообщения (save_message из
+        других потоков пишет их сразу), потом фоновый поток дописывает
+        всё, что в ней осталось, и завершается. Соединение закрывается,
+        даже если часть очереди не записалась; WriteBehindError
+        выбрасывается после этого.
+        """
+        failed: List[MessageRow] = []
         try:
-            cursor = conn.cursor()
-            # Проверяем, существует ли поле processed
-            cursor.execute("PRAGMA table_info(messages)")
-            columns = [row[1] for row in cursor.fetchall()]
-            
-            if "processed" not in columns:
-                # Добавляем поле processed
-                cursor.execute("ALTER TABLE messages ADD COLUMN processed INTEGER DEFAULT 0")
-                conn.commit()
-                print("Добавлено поле 'processed' в таблицу messages")
+            if self._writer is not None:
+                with self._enqueue_lock:
+                    self._closed = True
+                self._stop.set()
+                self._writer.join()
+                self._writer = None
+                failed = self._take_failed()
         finally:
-            conn.close()
+            with self._lock:
+                checkpoint(self._conn)
+                self._conn.close()
+        if failed:
+            raise WriteBehindError(failed, self._failure)
 
     def save_message(
-        self, message_id: int, chat_id: int, sender: str, text: str, date: str
-    ) -> bool:
+        self, message_id: int, chat_id: int, sender: str, text: str, ts: int
+    ) -> Optional[bool]:
         """Сохранить сообщение в БД.
         
+        Args:
+            ts: Дата сообщения в секундах Unix (UTC), как в Telegram API.
+        
         Returns:
             True если сообщение было добавлено, False если уже существует.
+            В режиме write_behind сообщение только ставится в очередь
+            и возвращается None (после close() оно пишется сразу).
         """
-        conn = self._get_connection()
-        try:
-            cursor = conn.cursor()
-            # Проверяем, существует ли сообщение
-            cursor.execute("SELECT 1 FROM messages WHERE id = ? LIMIT 1", (message_id,))
-            if cursor.fetchone():
-                return False  # Сообщение уже существует
-
-            # Вставляем новое сообщение (processed = 0 по умолчанию)
-            cursor.execute(
-                """
-                INSERT INTO messages (id, chat_id, sender, text, date, processed)
-                VALUES (?, ?, ?, ?, ?, 0)
-                """,
-                (message_id, chat_id, sender, text, date),
-            )
+        row = (message_id, chat_id, sender, text, ts)
+        if self._queue is not None:
+            with self._enqueue_lock:
+                if not self._closed:
+                    self._queue.put(row)
+                    return None
+        
+        with self._locked() as conn:
+            cursor = conn.execute(INSERT_MESSAGE_SQL, row)
             conn.commit()
-            return True
-        finally:
-            conn.close()
+            return cursor.rowcount > 0
 
-    def get_unprocessed_messages(self) -> List[Tuple[int, str, str]]:
-        """Получить все необработанные сообщения.
+    def save_messages(self, rows: Iterable[MessageRow]) -> int:
+        """Сохранить много сообщений одной транзакцией, пропуская дубликаты.
+        
+        Args:
+            rows: Кортежи (id, chat_id, sender, text, ts).
         
         Returns:
-            Список кортежей (id, sender, text) необработанных сообщений.
+            Число действительно добавленных сообщений.
+        """
+        with self._locked() as conn:
+            # rowcount, а не total_changes: тот учитывает и строки,
+            # изменённые триггерами статистики и FTS
+            cursor = conn.executemany(INSERT_MESSAGE_SQL, rows)
+            conn.commit()
+            return cursor.rowcount
+
+    def flush(self) -> None:
+        """Дождаться записи всего, что уже в очереди (без write_behind — ничего).
+
+        Raises:
+            WriteBehindError: Сообщения, которые не удалось записать
+                с прошлого flush().
+        """
+        if self._queue is None:
+            return
+        self._queue.join()
+        failed = self._take_failed()
+        if failed:
+            raise WriteBehindError(failed, self._failure)
+
+    def _wait_for_queue(self) -> None:
+        """Дождаться записи очереди перед чтением, не трогая список ошибок.
+
+        Ошибки прошлых записей выбрасывают только flush() и close(): из-за
+        плохой строки другого чата чтение не должно ломаться.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def _take_failed(self) -> List[MessageRow]:
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+    def _write_loop(self) -> None:
+        assert self._queue is not None
+        # После _stop поток дописывает остаток очереди и только потом выходит
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # Копим пачку, пока не наберётся batch_size или не выйдет время
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                inserted = self._write_batch(batch)
+                logger.debug("Записано %d сообщений (новых: %d)", len(batch), inserted)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch: List[MessageRow]) -> int:
+        """Записать пачку из очереди, ничего не потеряв молча.
+
+        Если пачка не записалась не из-за занятой базы, сообщения пишутся
+        по одному, чтобы одно плохое не потянуло за собой остальные;
+        оставшиеся ошибочными сохраняются для flush().
         """
-        conn = self._get_connection()
         try:
+            return self._save_when_free(batch)
+        except Exception:
+            logger.exception(
+                "Не удалось записать пачку из %d сообщений, пишу по одному", len(batch)
+            )
+        inserted = 0
+        for row in batch:
+            try:
+                inserted += self._save_when_free([row])
+            except Exception as exc:
+                logger.error("Не удалось записать сообщение %r: %s", row, exc)
+                with self._lock:
+                    self._failed.append(row)
+                    self._failure = exc
+        return inserted
+
+    def _save_when_free(self, rows: List[MessageRow]) -> int:
+        """save_messages, повторяемый с паузами, пока базу держит другой процесс.
+
+        Очередь тем временем заполняется, и при переполнении save_message
+        ждёт: долгая блокировка замедляет приём, а не теряет сообщения.
+        """
+        delay = BUSY_RETRY_DELAY
+        while True:
+            try:
+                return self.save_messages(rows)
+            except Exception as exc:
+                if not is_busy(exc):
+                    raise
+                logger.warning(
+                    "База занята, повтор записи %d сообщений через %.1f с", len(rows), delay
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, BUSY_RETRY_MAX_DELAY)
+
+    def get_unprocessed_messages(self, chat_id: int) -> List[Tuple[int, int, str, str]]:
+        """Получить необработанные сообщения чата.
+        
+        Необработанные — сообщения с id выше водяного знака чата
+        (chat_watermarks.last_processed_id); выборка идёт диапазоном по
+        первичному ключу (chat_id, id).
+        
+        Args:
+            chat_id: Чат, сообщения которого нужны.
+        
+        Returns:
+            Список кортежей (chat_id, id, sender, text) в порядке id.
+        """
+        self._wait_for_queue()  # Сообщения из очереди тоже должны попасть в выжимку
+        with self._locked() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                SELECT id, sender, text 
-                FROM messages 
-                WHERE processed = 0 
+                SELECT chat_id, id, sender, text
+                FROM messages
+                WHERE chat_id = ? AND id > COALESCE(
+                    (SELECT last_processed_id FROM chat_watermarks WHERE chat_id = ?),
+                    -1
+                )
                 ORDER BY id ASC
+                """,
+                (chat_id, chat_id),
+            )
+            return [(row[0], row[1], row[2], row[3]) for row in cursor.fetchall()]
+
+    def mark_processed_up_to(self, chat_id: int, message_id: int) -> None:
+        """Пометить обработанными все сообщения чата с id <= message_id.
+        
+        Одна UPSERT-строка в chat_watermarks вместо обновления каждого
+        сообщения; водяной знак никогда не сдвигается назад.
+        """
+        with self._locked() as conn:
+            conn.execute(
                 """
+                INSERT INTO chat_watermarks (chat_id, last_processed_id) VALUES (?, ?)
+                ON CONFLICT(chat_id) DO UPDATE
+                SET last_processed_id = MAX(last_processed_id, excluded.last_processed_id)
+                """,
+                (chat_id, message_id),
             )
-            return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
-        finally:
-            conn.close()
+            conn.commit()
+
+    def get_stats(self, chat_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получить счётчики сообщений одним запросом к таблице stats.
+
+        Счётчики поддерживаются триггерами при вставке/удалении и сдвиге
+        водяных знаков, поэтому чтение не зависит от размера таблицы messages.
 
-    def mark_messages_as_processed(self, message_ids: List[int]) -> None:
-        """Пометить сообщения как обработанные.
+        Args:
+            chat_id: Если указан, добавить число сообщений этого чата.
+
+        Returns:
+            Словарь с ключами total, processed, unprocessed, latest_date
+            и (если указан chat_id) chat_total.
+        """
+        self._wait_for_queue()
+        with self._locked() as conn:
+            row = conn.execute(
+                """
+                SELECT s.total_messages, s.processed_messages, s.latest_date,
+                       (SELECT message_count FROM chat_stats WHERE chat_id = ?)
+                FROM stats AS s
+                WHERE s.id = 1
+                """,
+                (chat_id,),
+            ).fetchone()
+
+        total, processed, latest_date, chat_total = row or (0, 0, None, None)
+        stats: Dict[str, Any] = {
+            "total": total,
+            "processed": processed,
+            "unprocessed": total - processed,
+            "latest_date": latest_date,
+        }
+        if chat_id is not None:
+            stats["chat_total"] = chat_total or 0
+        return stats
+
+    def enqueue_job(
+        self, chat_id: int, kind: str, reply_message_id: Optional[int] = None
+    ) -> Optional[int]:
+        """Поставить задачу суммаризации в очередь.
         
         Args:
-            message_ids: Список ID сообщений для пометки.
+            chat_id: Чат, в который отправляется результат.
+            kind: Тип задачи ("summarize" или "digest").
+            reply_message_id: Сообщение бота, которое задача отредактирует.
+        
+        Returns:
+            ID новой задачи или None, если такая же задача для чата уже
+            ждёт или выполняется.
         """
-        if not message_ids:
-            return
+        with self._locked() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            active = conn.execute(
+                """
+                SELECT 1 FROM summary_jobs
+                WHERE chat_id = ? AND kind = ? AND status IN ('pending', 'running')
+                """,
+                (chat_id, kind),
+            ).fetchone()
+            if active:
+                conn.rollback()
+                return None
+            now = time.time()
+            cursor = conn.execute(
+                """
+                INSERT INTO summary_jobs
+                    (chat_id, kind, reply_message_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (chat_id, kind, reply_message_id, now, now),
+            )
+            conn.commit()
+            return cursor.lastrowid
+
+    def claim_next_job(self) -> Optional[Dict[str, Any]]:
+        """Атомарно взять самую старую ожидающую задачу (status -> running).
         
-        conn = self._get_connection()
-        try:
-            cursor = conn.cursor()
-            placeholders = ",".join("?" * len(message_ids))
-            cursor.execute(
-                f"UPDATE messages SET processed = 1 WHERE id IN ({placeholders})",
-                message_ids,
+        Returns:
+            Словарь с полями задачи или None, если очередь пуста.
+        """
+        with self._locked() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """
+                SELECT id, chat_id, kind, reply_message_id, attempts
+                FROM summary_jobs
+                WHERE status = 'pending'
+                ORDER BY id
+                LIMIT 1
+                """
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                """
+                UPDATE summary_jobs
+                SET status = 'running', attempts = attempts + 1, updated_at = ?
+                WHERE id = ?
+                """,
+                (time.time(), row["id"]),
             )
             conn.commit()
-        finally:
-            conn.close()
+            job = dict(row)
+            job["attempts"] += 1
+            return job
 
-    def get_message_count(self, processed: Optional[bool] = None) -> int:
-        """Получить количество сообщений.
+    def finish_job(self, job_id: int, error: Optional[str] = None) -> None:
+        """Отметить задачу выполненной (или неудачной, если передан error)."""
+        with self._locked() as conn:
+            conn.execute(
+                "UPDATE summary_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                ("failed" if error else "done", error, time.time(), job_id),
+            )
+            conn.commit()
+
+    def requeue_interrupted_jobs(self, max_attempts: int = 3) -> int:
+        """Вернуть в очередь задачи, прерванные остановкой бота.
         
-        Args:
-            processed: Если None - все сообщения, True - обработанные, False - необработанные.
+        Задачи, которые уже max_attempts раз начинались и не завершились,
+        помечаются неудачными, чтобы не падать на них бесконечно.
+        
+        Returns:
+            Число задач, возвращённых в очередь.
         """
-        conn = self._get_connection()
-        try:
-            cursor = conn.cursor()
-            if processed is None:
-                cursor.execute("SELECT COUNT(*) FROM messages")
+        with self._locked() as conn:
+            now = time.time()
+            conn.execute(
+                """
+                UPDATE summary_jobs
+                SET status = 'failed', error = 'прервана слишком много раз', updated_at = ?
+                WHERE status = 'running' AND attempts >= ?
+                """,
+                (now, max_attempts),
+            )
+            cursor = conn.execute(
+                "UPDATE summary_jobs SET status = 'pending', updated_at = ? "
+                "WHERE status = 'running'",
+                (now,),
+            )
+            conn.commit()
+            return cursor.rowcount
+
+    def set_digest_schedule(
+        self, chat_id: int, interval_seconds: Optional[int]
+    ) -> None:
+        """Включить периодический дайджест чата или выключить его (None)."""
+        with self._locked() as conn:
+            if interval_seconds is None:
+                conn.execute(
+                    "DELETE FROM digest_schedules WHERE chat_id = ?", (chat_id,)
+                )
             else:
-                cursor.execute(
-                    "SELECT COUNT(*) FROM messages WHERE processed = ?",
-                    (1 if processed else 0,),
+                conn.execute(
+                    """
+                    INSERT INTO digest_schedules (chat_id, interval_seconds, next_run_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                        interval_seconds = excluded.interval_seconds,
+                        next_run_at = excluded.next_run_at
+                    """,
+                    (chat_id, interval_seconds, time.time() + interval_seconds),
                 )
-            return cursor.fetchone()[0]
-        finally:
-            conn.close()
+            conn.commit()
+
+    def get_digest_schedule(self, chat_id: int) -> Optional[int]:
+        """Интервал дайджеста чата в секундах или None, если он выключен."""
+        with self._locked() as conn:
+            row = conn.execute(
+                "SELECT interval_seconds FROM digest_schedules WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+            return row[0] if row else None
 
+    def claim_due_digests(self, now: Optional[float] = None) -> List[int]:
+        """Вернуть чаты, которым пора отправить дайджест, и сдвинуть их срок.
+        
+        Пропущенные (пока бот был выключен) запуски не накапливаются:
+        следующий срок считается от текущего момента.
+        """
+        now = time.time() if now is None else now
+        with self._locked() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            chat_ids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT chat_id FROM digest_schedules WHERE next_run_at <= ?",
+                    (now,),
+                )
+            ]
+            conn.execute(
+                """
+                UPDATE digest_schedules SET next_run_at = ? + interval_seconds
+                WHERE next_run_at <= ?
+                """,
+                (now, now),
+            )
+            conn.commit()
+            return chat_ids
@@ -0,0 +1,111 @@
+"""Фоновая очередь задач суммаризации и периодические дайджесты чатов."""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Интервалы дайджестов, доступные в команде /digest
+DIGEST_INTERVALS = {"hourly": 3600, "daily": 86400}
+
+
+class SummaryScheduler:
+    """Пул рабочих потоков, выполняющих задачи из таблицы summary_jobs.
+
+    Обработчики команд только ставят задачи в очередь (Database.enqueue_job)
+    и будят пул через notify(), поэтому долгий запрос к модели не блокирует
+    поток polling. Отдельный поток-таймер раз в tick_interval секунд ставит
+    в очередь дайджесты чатов, у которых подошёл срок. Состояние задач
+    хранится в БД: прерванные остановкой бота задачи при старте
+    возвращаются в очередь.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        run_job: Callable[[Dict[str, Any]], None],
+        *,
+        workers: int = 2,
+        tick_interval: float = 30.0,
+    ) -> None:
+        """
+        Args:
+            db: База данных с очередью задач.
+            run_job: Выполняет одну задачу; исключение помечает её неудачной.
+            workers: Число рабочих потоков.
+            tick_interval: Как часто проверять расписание дайджестов (секунды).
+        """
+        self.db = db
+        self.run_job = run_job
+        self.workers = workers
+        self.tick_interval = tick_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Вернуть прерванные задачи в очередь и запустить потоки."""
+        requeued = self.db.requeue_interrupted_jobs()
+        if requeued:
+            logger.info("Возвращено в очередь прерванных задач: %d", requeued)
+        self._threads = [
+            threading.Thread(target=self._tick_loop, name="digest-ticker", daemon=True)
+        ] + [
+            threading.Thread(
+                target=self._worker_loop, name=f"summary-worker-{i}", daemon=True
+            )
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.notify()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Остановить потоки (текущие задачи дорабатывают до конца)."""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def notify(self) -> None:
+        """Разбудить рабочие потоки: в очереди появилась задача."""
+        self._wake.set()
+
+    def _tick_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                for chat_id in self.db.claim_due_digests():
+                    if self.db.enqueue_job(chat_id, "digest") is not None:
+                        self.notify()
+            except Exception:
+                logger.exception("Ошибка при проверке расписания дайджестов")
+            self._stop.wait(self.tick_interval)
+
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self.db.claim_next_job()
+            except Exception:
+                logger.exception("Не удалось получить задачу из очереди")
+                job = None
+            if job is None:
+                self._wake.wait(self.tick_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        logger.info(
+            "Задача %d (%s) для чата %d: попытка %d",
+            job["id"], job["kind"], job["chat_id"], job["attempts"],
+        )
+        try:
+            self.run_job(job)
+        except Exception as exc:
+            logger.exception("Задача %d завершилась ошибкой", job["id"])
+            self.db.finish_job(job["id"], error=str(exc) or type(exc).__name__)
+        else:
+            self.db.finish_job(job["id"])
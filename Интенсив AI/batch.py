@@ -0,0 +1,159 @@
+import glob
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Set
+
+from gigachat import generate_summary, get_client
+from utils import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class BatchItem:
+    """One document to summarize; id is used to skip it on rerun."""
+
+    id: str
+    text: str
+
+
+@dataclass
+class BatchResult:
+    done: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+
+def _iter_files(paths: Iterable[str]) -> Iterator[BatchItem]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            yield BatchItem(id=path, text=f.read().strip())
+
+
+def _iter_jsonl(path: Path, text_field: str, id_field: str) -> Iterator[BatchItem]:
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            item_id = record.get(id_field)
+            yield BatchItem(
+                id=str(item_id) if item_id is not None else f"{path}:{lineno}",
+                text=str(record.get(text_field) or "").strip(),
+            )
+
+
+def iter_inputs(
+    source: str,
+    *,
+    pattern: str = "*.txt",
+    text_field: str = "text",
+    id_field: str = "id",
+) -> Iterator[BatchItem]:
+    """
+    Lazily read documents from a directory, a glob, a JSONL file or one file.
+
+    Files are identified by their path, JSONL records by id_field (or
+    "<file>:<line>" if the field is missing).
+    """
+    path = Path(source)
+    if path.is_dir():
+        return _iter_files(str(p) for p in sorted(path.glob(pattern)) if p.is_file())
+    if path.is_file() and path.suffix == ".jsonl":
+        return _iter_jsonl(path, text_field, id_field)
+    if path.is_file():
+        return _iter_files([str(path)])
+    matches = sorted(p for p in glob.glob(source, recursive=True) if os.path.isfile(p))
+    if not matches:
+        raise FileNotFoundError(f"Не найдено входных файлов: {source}")
+    return _iter_files(matches)
+
+
+def load_done_ids(output: str) -> Set[str]:
+    """
+    Collect ids that already have a summary in the output JSONL.
+
+    Failed records are not counted, so they are retried on rerun. A truncated
+    last line left by a crash is ignored.
+    """
+    done: Set[str] = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "summary" in record:
+                done.add(record["id"])
+    return done
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _summarize(item: BatchItem, use_cache: bool) -> Dict[str, str]:
+    try:
+        return {"id": item.id, "summary": generate_summary(item.text, use_cache=use_cache)}
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Не удалось обработать %s: %s", item.id, exc)
+        return {"id": item.id, "error": str(exc)}
+
+
+def run_batch(
+    items: Iterable[BatchItem],
+    output: str,
+    *,
+    workers: int = 4,
+    use_cache: bool = True,
+) -> BatchResult:
+    """
+    Summarize items concurrently and append each result to output as soon as
+    it is ready.
+
+    Items whose id already has a summary in output are skipped. At most
+    2 * workers documents are held in memory at once, and only the calling
+    thread writes to the file, so a crash loses only in-flight work.
+    """
+    get_client(pool_size=workers)
+    result = BatchResult()
+    done_ids = load_done_ids(output)
+    pending: Set[Future] = set()
+
+    def collect(futures: Set[Future], out) -> None:
+        for future in futures:
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if "summary" in record:
+                result.done += 1
+            else:
+                result.failed += 1
+            if (result.done + result.failed) % 100 == 0:
+                logger.info("Обработано документов: %d", result.done + result.failed)
+
+    with open(output, "a", encoding="utf-8") as out, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        if out.tell() and not _ends_with_newline(output):
+            out.write("\n")  # не дописывать к строке, оборванной при сбое
+        for item in items:
+            if item.id in done_ids:
+                result.skipped += 1
+                continue
+            done_ids.add(item.id)
+            pending.add(executor.submit(_summarize, item, use_cache))
+            if len(pending) >= workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished, out)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished, out)
+    return result
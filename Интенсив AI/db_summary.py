@@ -0,0 +1,192 @@
+"""Summarize chats straight from the collector's database (Интенсив/messages.db).
+
+Rows are streamed from a read-only SQLite cursor and fed lazily into the
+map-reduce summarizer, so neither the whole chat nor one giant prompt string
+is ever held in memory.
+"""
+
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Путь к базе и настройки соединений общие с коллектором (папка Интенсив)
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Интенсив"))
+from dbconfig import connect, resolve_db_path  # noqa: E402
+from gigachat import generate_summary, get_client, stream_summary  # noqa: E402
+from summarizer import map_reduce_summarize  # noqa: E402
+from utils import get_logger  # noqa: E402
+
+logger = get_logger(__name__)
+
+FETCH_SIZE = 500
+
+
+def connect_readonly(path: Optional[str] = None) -> sqlite3.Connection:
+    """Open the messages database read-only, so the collector is never blocked.
+
+    Without path the shared location (MESSAGES_DB_PATH or Интенсив/messages.db)
+    is used.
+    """
+    path = resolve_db_path(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"База данных не найдена: {path}")
+    return connect(path, readonly=True)
+
+
+def to_epoch(value: str) -> int:
+    """ISO date/datetime to epoch seconds; a value without offset is UTC."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise ValueError(f"Некорректная дата: {value}") from exc
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def _where(
+    chat_ids: Sequence[int], since: Optional[str], until: Optional[str]
+) -> Tuple[str, List]:
+    clauses = []
+    params: List = []
+    if chat_ids:
+        clauses.append(f"chat_id IN ({', '.join('?' * len(chat_ids))})")
+        params.extend(chat_ids)
+    if since:
+        clauses.append("ts >= ?")
+        params.append(to_epoch(since))
+    if until:
+        clauses.append("ts < ?")
+        params.append(to_epoch(until))
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+def iter_message_lines(
+    conn: sqlite3.Connection,
+    *,
+    chat_ids: Sequence[int] = (),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Yield "[sender]: text" lines in chronological order.
+
+    since/until are ISO dates compared like the dashboard filters
+    (since inclusive, until exclusive) against the integer ts column. Rows
+    are fetched FETCH_SIZE at a time along the ts / (chat_id, ts) index.
+    """
+    where, params = _where(chat_ids, since, until)
+    cursor = conn.execute(
+        f"SELECT sender, text FROM messages {where} ORDER BY ts, rowid", params
+    )
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for sender, text in rows:
+            if text and text.strip():
+                yield f"[{sender}]: {text}"
+
+
+def list_chat_ids(
+    conn: sqlite3.Connection,
+    *,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[int]:
+    """Chats that have messages in the given time window."""
+    where, params = _where((), since, until)
+    rows = conn.execute(
+        f"SELECT DISTINCT chat_id FROM messages {where} ORDER BY chat_id", params
+    )
+    return [chat_id for (chat_id,) in rows]
+
+
+def summarize_from_db(
+    db_path: Optional[str],
+    *,
+    chat_ids: Sequence[int] = (),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    use_cache: bool = True,
+    max_tokens: int = 6000,
+    max_workers: int = 4,
+    on_piece: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Summarize all matching messages (of all chat_ids together) via map-reduce.
+
+    With on_piece, the final (combine) request is streamed and on_piece
+    gets the summary as it is generated.
+    """
+
+    def combine(text: str) -> str:
+        if on_piece is None:
+            return generate_summary(text, use_cache=use_cache)
+        pieces = []
+        for piece in stream_summary(text, use_cache=use_cache):
+            on_piece(piece)
+            pieces.append(piece)
+        return "".join(pieces).strip()
+
+    conn = connect_readonly(db_path)
+    try:
+        lines = iter_message_lines(conn, chat_ids=chat_ids, since=since, until=until)
+        return map_reduce_summarize(
+            lines,
+            lambda chunk: generate_summary(chunk, use_cache=use_cache),
+            combine,
+            max_tokens=max_tokens,
+            max_workers=max_workers,
+        )
+    finally:
+        conn.close()
+
+
+def summarize_chats_from_db(
+    db_path: Optional[str],
+    *,
+    chat_ids: Sequence[int] = (),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    use_cache: bool = True,
+    max_tokens: int = 6000,
+    max_workers: int = 4,
+    parallel_chats: int = 4,
+) -> Dict[int, Union[str, Exception]]:
+    """
+    Summarize every chat separately, parallel_chats chats at a time.
+
+    Without chat_ids, all chats with messages in the window are used. Each
+    chat gets its own read-only connection. A failed chat maps to an
+    exception in the result instead of aborting the others.
+    """
+    if not chat_ids:
+        conn = connect_readonly(db_path)
+        try:
+            chat_ids = list_chat_ids(conn, since=since, until=until)
+        finally:
+            conn.close()
+    get_client(pool_size=parallel_chats * max_workers)
+
+    def summarize_one(chat_id: int) -> Union[str, Exception]:
+        try:
+            return summarize_from_db(
+                db_path,
+                chat_ids=[chat_id],
+                since=since,
+                until=until,
+                use_cache=use_cache,
+                max_tokens=max_tokens,
+                max_workers=max_workers,
+            )
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Не удалось суммаризировать чат %s: %s", chat_id, exc)
+            return exc
+
+    with ThreadPoolExecutor(max_workers=parallel_chats) as executor:
+        return dict(zip(chat_ids, executor.map(summarize_one, chat_ids)))
@@ -1,9 +1,10 @@
 import os
-from typing import Any, Dict, Optional
+from typing import Iterator, Optional
 
-import requests
 from dotenv import load_dotenv
 
+from openrouter import OpenRouterClient, OpenRouterError
+from summary_cache import SummaryCache, cache_key
 from utils import get_logger
 
 load_dotenv()
@@ -11,10 +12,10 @@ logger = get_logger(__name__)
 
 DEFAULT_MODEL = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct:free")
 DEFAULT_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+SYSTEM_PROMPT = "Ты – ассистент, который делает краткие выжимки текста."
 
-
-class OpenRouterError(RuntimeError):
-    """Raised when OpenRouter API responds with an error."""
+_client: Optional[OpenRouterClient] = None
+_cache: Optional[SummaryCache] = None
 
 
 def get_access_token() -> str:
@@ -30,59 +31,98 @@ def get_access_token() -> str:
     return api_key
 
 
-def _post(url: str, headers: Dict[str, str], payload: Dict[str, Any]) -> Dict[str, Any]:
-    try:
-        response = requests.post(url, json=payload, headers=headers, timeout=60)
-    except requests.RequestException as exc:
-        raise OpenRouterError(f"Ошибка сети при обращении к OpenRouter: {exc}") from exc
+def get_client(pool_size: int = 10) -> OpenRouterClient:
+    """
+    Return the process-wide OpenRouter client, creating it on first use.
 
-    if not response.ok:
-        raise OpenRouterError(
-            f"OpenRouter вернул ошибку {response.status_code}: {response.text}"
+    Reusing one client keeps the HTTPS connection alive between calls.
+    pool_size (kept-alive connections) only applies to the first call.
+    """
+    global _client
+    if _client is None:
+        _client = OpenRouterClient(
+            get_access_token(),
+            model=DEFAULT_MODEL,
+            base_url=DEFAULT_BASE_URL,
+            referer="https://github.com",  # OpenRouter рекомендует указывать
+            title="CLI Summary Tool",
+            pool_size=pool_size,
         )
+    return _client
 
-    try:
-        return response.json()
-    except ValueError as exc:
-        raise OpenRouterError("Не удалось распарсить ответ OpenRouter как JSON") from exc
 
+def get_cache() -> SummaryCache:
+    """
+    Return the process-wide summary cache, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        _cache = SummaryCache()
+    return _cache
 
-def generate_summary(text: str, *, model: Optional[str] = None) -> str:
+
+def generate_summary(
+    text: str, *, model: Optional[str] = None, use_cache: bool = True
+) -> str:
     """
     Send text to OpenRouter chat/completions for summarization.
+
+    Identical requests (same model, prompt and normalized text) are served
+    from the on-disk summary cache unless use_cache is False.
     """
     if not text or not text.strip():
         raise ValueError("Текст для суммаризации пуст.")
 
-    api_key = get_access_token()
-    chosen_model = model or DEFAULT_MODEL
-    url = f"{DEFAULT_BASE_URL}/chat/completions"
-
-    payload = {
-        "model": chosen_model,
-        "messages": [
-            {
-                "role": "system",
-                "content": "Ты – ассистент, который делает краткие выжимки текста.",
-            },
-            {"role": "user", "content": text},
-        ],
-    }
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "https://github.com",  # OpenRouter рекомендует указывать
-        "X-Title": "CLI Summary Tool",
-        "Content-Type": "application/json",
-    }
-
-    logger.info("Отправляю запрос в OpenRouter (модель: %s)...", chosen_model)
-    data = _post(url, headers, payload)
-    choice = data.get("choices", [{}])[0]
-    message = choice.get("message", {})
-    content = message.get("content")
-    if not content:
-        raise OpenRouterError("Не удалось получить ответ от модели.")
-    logger.info("Суммаризация получена.")
-    return content.strip()
+    client = get_client()
+    chosen_model = model or client.model
+
+    def request() -> str:
+        logger.info("Отправляю запрос в OpenRouter (модель: %s)...", chosen_model)
+        content = client.complete(SYSTEM_PROMPT, text, model=chosen_model)
+        logger.info("Суммаризация получена.")
+        return content
 
+    if not use_cache:
+        return request()
+
+    cache = get_cache()
+    key = cache_key(chosen_model, SYSTEM_PROMPT, text)
+    content = cache.get(key)
+    if content is not None:
+        logger.info("Выжимка взята из кэша.")
+        return content
+    content = request()
+    cache.put(key, content)
+    return content
+
+
+def stream_summary(
+    text: str, *, model: Optional[str] = None, use_cache: bool = True
+) -> Iterator[str]:
+    """
+    Like generate_summary, but yield the summary piece by piece as OpenRouter
+    streams it. A cached summary is yielded at once.
+    """
+    if not text or not text.strip():
+        raise ValueError("Текст для суммаризации пуст.")
+
+    client = get_client()
+    chosen_model = model or client.model
+    cache = get_cache() if use_cache else None
+    key = cache_key(chosen_model, SYSTEM_PROMPT, text)
+
+    if cache is not None:
+        content = cache.get(key)
+        if content is not None:
+            logger.info("Выжимка взята из кэша.")
+            yield content
+            return
+
+    logger.info("Отправляю потоковый запрос в OpenRouter (модель: %s)...", chosen_model)
+    pieces = []
+    for piece in client.stream_complete(SYSTEM_PROMPT, text, model=chosen_model):
+        pieces.append(piece)
+        yield piece
+    logger.info("Суммаризация получена.")
+    if cache is not None:
+        cache.put(key, "".join(pieces).strip())
@@ -1,7 +1,9 @@
 import argparse
 import sys
 
-from gigachat import OpenRouterError, generate_summary
+from batch import iter_inputs, run_batch
+from db_summary import summarize_chats_from_db, summarize_from_db
+from gigachat import OpenRouterError, generate_summary, get_cache, stream_summary
 from utils import choose_input, get_logger
 
 logger = get_logger("cli")
@@ -16,18 +18,161 @@ def build_parser() -> argparse.ArgumentParser:
     summary = subparsers.add_parser("summary", help="Сделать краткую выжимку текста.")
     summary.add_argument("--file", type=str, help="Путь к файлу с текстом.")
     summary.add_argument("--text", type=str, help="Текст напрямую.")
+    summary.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Не брать выжимку из кэша и не сохранять её туда.",
+    )
+    summary.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Печатать выжимку по мере генерации (по умолчанию включено, кроме --per-chat).",
+    )
+    source = summary.add_argument_group(
+        "выжимка из базы сообщений",
+        "Читать сообщения прямо из messages.db (папка Интенсив) вместо текста.",
+    )
+    source.add_argument(
+        "--db",
+        nargs="?",
+        const="",
+        help="Путь к messages.db; без значения — $MESSAGES_DB_PATH или база из папки Интенсив.",
+    )
+    source.add_argument(
+        "--chat",
+        type=int,
+        action="append",
+        default=[],
+        help="ID чата (можно указать несколько раз). По умолчанию — все чаты.",
+    )
+    source.add_argument("--since", help="Сообщения начиная с даты (ISO, включительно).")
+    source.add_argument("--until", help="Сообщения до даты (ISO, не включительно).")
+    source.add_argument(
+        "--per-chat",
+        action="store_true",
+        help="Отдельная выжимка для каждого чата (чаты обрабатываются параллельно).",
+    )
+    source.add_argument(
+        "--parallel-chats", type=int, default=4, help="Сколько чатов обрабатывать одновременно."
+    )
+    source.add_argument(
+        "--workers", type=int, default=4, help="Сколько запросов на чат выполнять одновременно."
+    )
+    source.add_argument(
+        "--chunk-tokens", type=int, default=6000, help="Бюджет токенов на один запрос."
+    )
+
+    batch = subparsers.add_parser(
+        "batch", help="Сделать выжимки множества документов параллельно."
+    )
+    batch.add_argument(
+        "input", help="Папка, glob-шаблон (в кавычках), JSONL-файл или один файл."
+    )
+    batch.add_argument(
+        "--output", required=True, help="JSONL-файл результатов (дописывается)."
+    )
+    batch.add_argument(
+        "--workers", type=int, default=4, help="Сколько запросов выполнять одновременно."
+    )
+    batch.add_argument(
+        "--pattern", default="*.txt", help="Шаблон файлов внутри папки (по умолчанию *.txt)."
+    )
+    batch.add_argument("--text-field", default="text", help="Поле с текстом в JSONL.")
+    batch.add_argument("--id-field", default="id", help="Поле с идентификатором в JSONL.")
+    batch.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Не брать выжимки из кэша и не сохранять их туда.",
+    )
+
+    cache = subparsers.add_parser("cache", help="Кэш выжимок.")
+    cache.add_argument("action", choices=["stats", "clear"])
     return parser
 
 
+def handle_db_summary(args: argparse.Namespace) -> int:
+    options = dict(
+        chat_ids=args.chat,
+        since=args.since,
+        until=args.until,
+        use_cache=not args.no_cache,
+        max_tokens=args.chunk_tokens,
+        max_workers=args.workers,
+    )
+    if not args.per_chat:
+        # Частичные выжимки готовятся молча, итоговая печатается по мере генерации
+        streamed = []
+
+        def print_piece(piece: str) -> None:
+            if not streamed:
+                print("Краткая выжимка:\n")
+            streamed.append(piece)
+            print(piece, end="", flush=True)
+
+        try:
+            summary_text = summarize_from_db(
+                args.db or None,
+                on_piece=print_piece if args.stream is not False else None,
+                **options,
+            )
+        except OpenRouterError as exc:
+            if streamed:
+                print()
+            logger.error("Ошибка API: %s", exc)
+            return 1
+        except Exception as exc:  # noqa: BLE001
+            if streamed:
+                print()
+            logger.error("Ошибка: %s", exc)
+            return 1
+        if streamed:
+            print()
+        else:
+            print("Краткая выжимка:\n")
+            print(summary_text)
+        return 0
+
+    try:
+        results = summarize_chats_from_db(
+            args.db or None, parallel_chats=args.parallel_chats, **options
+        )
+    except Exception as exc:  # noqa: BLE001
+        logger.error("Ошибка: %s", exc)
+        return 1
+    if not results:
+        logger.error("Нет сообщений по заданным условиям.")
+        return 1
+
+    failed = 0
+    for chat_id, summary_text in results.items():
+        print(f"Чат {chat_id}:\n")
+        if isinstance(summary_text, Exception):
+            failed += 1
+            print(f"Ошибка: {summary_text}\n")
+        else:
+            print(f"{summary_text}\n")
+    return 1 if failed else 0
+
+
 def handle_summary(args: argparse.Namespace) -> int:
+    if args.db is not None:
+        return handle_db_summary(args)
+    if args.chat or args.since or args.until or args.per_chat:
+        logger.error("--chat, --since, --until и --per-chat работают только вместе с --db.")
+        return 1
+
     try:
         user_text = choose_input(args.text, args.file)
     except Exception as exc:  # noqa: BLE001
         logger.error("%s", exc)
         return 1
 
+    if args.stream is not False:
+        return print_summary_stream(user_text, use_cache=not args.no_cache)
+
     try:
-        summary_text = generate_summary(user_text)
+        summary_text = generate_summary(user_text, use_cache=not args.no_cache)
     except OpenRouterError as exc:
         logger.error("Ошибка API: %s", exc)
         return 1
@@ -40,12 +185,89 @@ def handle_summary(args: argparse.Namespace) -> int:
     return 0
 
 
+def print_summary_stream(user_text: str, *, use_cache: bool) -> int:
+    """Печатать токены выжимки по мере их прихода от OpenRouter."""
+    header_printed = False
+    try:
+        for piece in stream_summary(user_text, use_cache=use_cache):
+            if not header_printed:
+                print("Краткая выжимка:\n")
+                header_printed = True
+            print(piece, end="", flush=True)
+    except OpenRouterError as exc:
+        if header_printed:
+            print()
+        logger.error("Ошибка API: %s", exc)
+        return 1
+    except Exception as exc:  # noqa: BLE001
+        if header_printed:
+            print()
+        logger.error("Неожиданная ошибка: %s", exc)
+        return 1
+
+    print()
+    return 0
+
+
+def handle_batch(args: argparse.Namespace) -> int:
+    if args.workers < 1:
+        logger.error("--workers должно быть не меньше 1.")
+        return 1
+    try:
+        items = iter_inputs(
+            args.input,
+            pattern=args.pattern,
+            text_field=args.text_field,
+            id_field=args.id_field,
+        )
+        result = run_batch(
+            items, args.output, workers=args.workers, use_cache=not args.no_cache
+        )
+    except OpenRouterError as exc:
+        logger.error("Ошибка API: %s", exc)
+        return 1
+    except Exception as exc:  # noqa: BLE001
+        logger.error("Неожиданная ошибка: %s", exc)
+        return 1
+
+    logger.info(
+        "Готово: %d, с ошибкой: %d, пропущено (уже есть в %s): %d",
+        result.done,
+        result.failed,
+        args.output,
+        result.skipped,
+    )
+    return 1 if result.failed else 0
+
+
+def handle_cache(args: argparse.Namespace) -> int:
+    cache = get_cache()
+    if args.action == "clear":
+        cache.clear()
+        print(f"Кэш очищен: {cache.path}")
+        return 0
+
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0.0
+    print(f"Файл кэша: {cache.path}")
+    print(f"Записей: {stats['entries']}")
+    print(f"Попаданий: {stats['hits']}, промахов: {stats['misses']} ({hit_rate:.1f}%)")
+    return 0
+
+
 def main() -> int:
     parser = build_parser()
     args = parser.parse_args()
 
+    if args.command == "summary" and args.per_chat and args.stream:
+        parser.error("--stream нельзя совместить с --per-chat: чаты суммаризируются параллельно")
     if args.command == "summary":
         return handle_summary(args)
+    if args.command == "batch":
+        return handle_batch(args)
+    if args.command == "cache":
+        return handle_cache(args)
 
     parser.print_help()
     return 1
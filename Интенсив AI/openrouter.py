@@ -0,0 +1,482 @@
+"""Shared OpenRouter chat/completions client for the CLI and the Telegram bot.
+
+One :class:`OpenRouterClient` keeps a ``requests.Session`` with a pooled,
+keep-alive connection to the API, so repeated calls skip DNS/TCP/TLS setup.
+The asyncio API runs the same pooled session in a dedicated thread pool,
+which lets many requests be in flight at once.
+
+Every request first takes a token from a shared :class:`RateLimiter`, so
+concurrent callers (threads or coroutines) queue up instead of tripping the
+API limit, and 429/5xx/network failures are retried with jittered
+exponential backoff.
+"""
+
+import asyncio
+import email.utils
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+
+
+T = TypeVar("T")
+
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class OpenRouterError(RuntimeError):
+    """Raised when OpenRouter API responds with an error."""
+
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait from ``Retry-After`` (delta seconds or HTTP date)."""
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def _parse_reset(value: float) -> float:
+    """Seconds until ``X-RateLimit-Reset`` (epoch ms, epoch s or delta s)."""
+    if value > 1e12:
+        value /= 1000.0
+    if value > 1e9:
+        return max(0.0, value - time.time())
+    return max(0.0, value)
+
+
+def _iter_sse_data(response: requests.Response) -> Iterator[str]:
+    """Yield the ``data:`` payloads of a server-sent events stream.
+
+    Lines are decoded as UTF-8 explicitly: ``text/event-stream`` responses
+    usually have no charset and requests would otherwise assume Latin-1.
+    Comment lines (``: OPENROUTER PROCESSING`` keep-alives) are skipped.
+    """
+    for raw in response.iter_lines():
+        line = raw.decode("utf-8")
+        if line.startswith("data:"):
+            yield line[5:].strip()
+
+
+class RateLimiter:
+    """Adaptive token bucket shared by threads and coroutines.
+
+    Callers reserve a token under a lock and then sleep outside it (with
+    ``time.sleep`` or ``asyncio.sleep``), so waiters are served in arrival
+    order and nobody spins. The rate adapts AIMD-style: it is halved on a
+    429 (down to ``min_rate``) and creeps back to ``max_rate`` on success.
+    ``X-RateLimit-*`` / ``Retry-After`` response headers pause the whole
+    bucket until the server-side window resets.
+
+    Args:
+        rate: Requests per second; ``OPENROUTER_RPM`` / 60 or 1 by default.
+        burst: Bucket size; ``OPENROUTER_BURST`` or 5 by default.
+        clock: Monotonic clock, replaceable in tests.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_rate = rate or _env_float("OPENROUTER_RPM", 60.0) / 60.0
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = burst or _env_float("OPENROUTER_BURST", 5.0)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._paused_until - now)
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller for ``seconds`` (server-side limit hit)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def on_success(self, headers: Mapping[str, str]) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        self._apply_headers(headers)
+
+    def on_throttled(self, headers: Mapping[str, str], delay: float) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        self.pause(delay)
+        self._apply_headers(headers)
+
+    def _apply_headers(self, headers: Mapping[str, str]) -> None:
+        remaining = _header_float(headers, "X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        with self._lock:
+            self._tokens = min(self._tokens, remaining)
+        reset = _header_float(headers, "X-RateLimit-Reset")
+        if remaining <= 0 and reset is not None:
+            self.pause(_parse_reset(reset))
+
+
+class OpenRouterClient:
+    """Pooled OpenRouter client with a sync and an asyncio API.
+
+    Args:
+        api_key: OpenRouter API key.
+        model: Model used when a call does not pass its own.
+        base_url: API root; ``OPENROUTER_BASE_URL`` or the public API by
+            default. Point it at a local stub server in tests.
+        referer, title: Optional ``HTTP-Referer`` / ``X-Title`` headers.
+        connect_timeout, read_timeout: Seconds; ``OPENROUTER_CONNECT_TIMEOUT``
+            / ``OPENROUTER_READ_TIMEOUT`` or 10 / 60 by default.
+        pool_size: Kept-alive connections and async worker threads.
+        rate_limiter: Limiter shared by all calls of this client; a new
+            :class:`RateLimiter` configured from the environment by default.
+        max_retries: Retries for 429/5xx/network errors;
+            ``OPENROUTER_MAX_RETRIES`` or 5 by default.
+        backoff_base, backoff_max: Seconds; the n-th retry waits a random
+            time up to ``min(backoff_max, backoff_base * 2**n)`` unless the
+            server sent ``Retry-After``.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        model: str,
+        base_url: Optional[str] = None,
+        referer: Optional[str] = None,
+        title: Optional[str] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        pool_size: int = 10,
+        rate_limiter: Optional[RateLimiter] = None,
+        max_retries: Optional[int] = None,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ) -> None:
+        self.model = model
+        self.base_url = (
+            base_url or os.getenv("OPENROUTER_BASE_URL") or DEFAULT_BASE_URL
+        ).rstrip("/")
+        self.timeout = (
+            connect_timeout
+            if connect_timeout is not None
+            else _env_float("OPENROUTER_CONNECT_TIMEOUT", 10.0),
+            read_timeout
+            if read_timeout is not None
+            else _env_float("OPENROUTER_READ_TIMEOUT", 60.0),
+        )
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = (
+            max_retries
+            if max_retries is not None
+            else int(_env_float("OPENROUTER_MAX_RETRIES", 5))
+        )
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers.update(
+            {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            }
+        )
+        if referer:
+            self._session.headers["HTTP-Referer"] = referer
+        if title:
+            self._session.headers["X-Title"] = title
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self) -> "OpenRouterClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close pooled connections and the async worker threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._session.close()
+
+    def _payload(
+        self, messages: List[Dict[str, str]], model: Optional[str]
+    ) -> Dict[str, Any]:
+        return {"model": model or self.model, "messages": messages}
+
+    def _open(
+        self, path: str, payload: Dict[str, Any], *, stream: bool = False
+    ) -> requests.Response:
+        """Make one HTTP attempt and feed the response back to the limiter."""
+        url = f"{self.base_url}{path}"
+        try:
+            response = self._session.post(
+                url, json=payload, timeout=self.timeout, stream=stream
+            )
+        except requests.RequestException as exc:
+            raise OpenRouterError(
+                f"Ошибка сети при обращении к OpenRouter: {exc}"
+            ) from exc
+
+        if not response.ok:
+            retry_after = _parse_retry_after(response.headers)
+            if response.status_code == 429:
+                self.rate_limiter.on_throttled(
+                    response.headers,
+                    retry_after if retry_after is not None else self.backoff_base,
+                )
+            raise OpenRouterError(
+                f"OpenRouter вернул ошибку {response.status_code}: {response.text}",
+                status_code=response.status_code,
+                retry_after=retry_after,
+            )
+        self.rate_limiter.on_success(response.headers)
+        return response
+
+    def _send(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = self._open(path, payload)
+        try:
+            return response.json()
+        except ValueError as exc:
+            raise OpenRouterError(
+                "Не удалось распарсить ответ OpenRouter как JSON"
+            ) from exc
+
+    def _retry_delay(self, exc: OpenRouterError, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, or None if the error is final."""
+        retryable = exc.status_code is None or exc.status_code in RETRY_STATUSES
+        if not retryable or attempt >= self.max_retries:
+            return None
+        if exc.retry_after is not None:
+            return exc.retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _backoff(self, exc: OpenRouterError, attempt: int) -> float:
+        """Log and return the delay before retrying ``exc``; re-raise it if final.
+
+        Shared by the sync (:meth:`_retrying`) and async (:meth:`_apost`)
+        retry loops, which only differ in how they wait.
+        """
+        delay = self._retry_delay(exc, attempt)
+        if delay is None:
+            raise exc
+        logger.warning(
+            "OpenRouter: %s, повтор %d/%d через %.1f с",
+            exc.status_code or "ошибка сети",
+            attempt + 1,
+            self.max_retries,
+            delay,
+        )
+        return delay
+
+    def _retrying(self, send: Callable[[], T]) -> T:
+        """Call ``send`` under the rate limiter, retrying transient errors."""
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                return send()
+            except OpenRouterError as exc:
+                delay = self._backoff(exc, attempt)
+            time.sleep(delay)
+            attempt += 1
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self._retrying(functools.partial(self._send, path, payload))
+
+    async def _apost(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Asyncio version of :meth:`_post`: only the HTTP call uses a thread."""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_async()
+            try:
+                return await loop.run_in_executor(
+                    self._get_executor(), self._send, path, payload
+                )
+            except OpenRouterError as exc:
+                delay = self._backoff(exc, attempt)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _content(data: Dict[str, Any]) -> str:
+        choices = data.get("choices") or [{}]
+        content = (choices[0].get("message") or {}).get("content")
+        if not content or not content.strip():
+            raise OpenRouterError(f"OpenRouter вернул пустой ответ: {data}")
+        return content.strip()
+
+    def chat(
+        self, messages: List[Dict[str, str]], *, model: Optional[str] = None
+    ) -> str:
+        """Send a chat/completions request and return the reply text."""
+        data = self._post("/chat/completions", self._payload(messages, model))
+        return self._content(data)
+
+    def complete(
+        self, system_prompt: str, user_prompt: str, *, model: Optional[str] = None
+    ) -> str:
+        """Shortcut for a system + user message pair."""
+        return self.chat(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            model=model,
+        )
+
+    def stream_chat(
+        self, messages: List[Dict[str, str]], *, model: Optional[str] = None
+    ) -> Iterator[str]:
+        """Send a streaming chat/completions request and yield text deltas.
+
+        The request is retried like :meth:`chat` until the stream opens;
+        errors after the first token are raised as :class:`OpenRouterError`.
+        Leading whitespace of the reply is dropped.
+        """
+        payload = dict(self._payload(messages, model), stream=True)
+        response = self._retrying(
+            functools.partial(self._open, "/chat/completions", payload, stream=True)
+        )
+        started = False
+        with response:
+            try:
+                for data in _iter_sse_data(response):
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError as exc:
+                        raise OpenRouterError(
+                            f"Не удалось распарсить событие потока OpenRouter: {data}"
+                        ) from exc
+                    if chunk.get("error"):
+                        raise OpenRouterError(
+                            f"OpenRouter прервал поток: {chunk['error']}"
+                        )
+                    choices = chunk.get("choices") or [{}]
+                    text = (choices[0].get("delta") or {}).get("content") or ""
+                    if not started:
+                        text = text.lstrip()
+                        started = bool(text)
+                    if text:
+                        yield text
+            except requests.RequestException as exc:
+                raise OpenRouterError(
+                    f"Ошибка сети при чтении потока OpenRouter: {exc}"
+                ) from exc
+        if not started:
+            raise OpenRouterError("OpenRouter вернул пустой ответ")
+
+    def stream_complete(
+        self, system_prompt: str, user_prompt: str, *, model: Optional[str] = None
+    ) -> Iterator[str]:
+        """Streaming version of :meth:`complete`."""
+        return self.stream_chat(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            model=model,
+        )
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.pool_size, thread_name_prefix="openrouter"
+            )
+        return self._executor
+
+    async def achat(
+        self, messages: List[Dict[str, str]], *, model: Optional[str] = None
+    ) -> str:
+        """Asyncio version of :meth:`chat`."""
+        data = await self._apost("/chat/completions", self._payload(messages, model))
+        return self._content(data)
+
+    async def acomplete(
+        self, system_prompt: str, user_prompt: str, *, model: Optional[str] = None
+    ) -> str:
+        """Asyncio version of :meth:`complete`."""
+        return await self.achat(
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            model=model,
+        )
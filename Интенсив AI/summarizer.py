@@ -0,0 +1,100 @@
+"""Map-reduce суммаризация переписки, которая не помещается в один запрос."""
+
+import itertools
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, List
+
+# Грубая оценка: для смеси кириллицы и латиницы ~3 символа на токен
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценить число токенов в тексте без токенизатора модели."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def chunk_lines(lines: Iterable[str], max_tokens: int) -> Iterator[str]:
+    """Сгруппировать строки (сообщения) в фрагменты не больше max_tokens.
+
+    Сообщения не разрываются между фрагментами. Исключение — одно
+    сообщение длиннее бюджета: оно режется на куски по max_tokens, чтобы
+    ни один символ не потерялся.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunk: List[str] = []
+    size = 0
+    for line in lines:
+        if len(line) > max_chars:
+            if chunk:
+                yield "\n\n".join(chunk)
+                chunk, size = [], 0
+            for start in range(0, len(line), max_chars):
+                yield line[start:start + max_chars]
+            continue
+        if chunk and size + len(line) + 2 > max_chars:
+            yield "\n\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 2
+    if chunk:
+        yield "\n\n".join(chunk)
+
+
+def map_reduce_summarize(
+    lines: Iterable[str],
+    summarize_chunk: Callable[[str], str],
+    combine: Callable[[str], str],
+    *,
+    max_tokens: int = 6000,
+    max_workers: int = 4,
+) -> str:
+    """Суммаризировать произвольно длинную переписку целиком.
+
+    Map: фрагменты по max_tokens суммаризируются параллельно в
+    max_workers потоков. Reduce: частичные выжимки объединяются через
+    combine; если они сами не помещаются в бюджет, шаг повторяется.
+    Если весь текст помещается в один фрагмент, вызывается только combine.
+
+    lines читаются лениво: можно передать курсор БД, и переписка целиком
+    не окажется в памяти.
+
+    Args:
+        lines: Сообщения в хронологическом порядке.
+        summarize_chunk: Выжимка одного фрагмента (бросает исключение при ошибке).
+        combine: Итоговая выжимка из текста или частичных выжимок.
+        max_tokens: Бюджет токенов на один запрос.
+        max_workers: Сколько запросов выполнять одновременно.
+    """
+    chunk_iter = chunk_lines(lines, max_tokens)
+    first = next(chunk_iter, None)
+    if first is None:
+        raise ValueError("Нечего суммаризировать.")
+    second = next(chunk_iter, None)
+    if second is None:
+        return combine(first)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Первый уровень map: фрагменты читаются по мере освобождения
+        # потоков (не больше 2 * max_workers наперёд), в памяти остаются
+        # только частичные выжимки
+        partials: List[str] = []
+        pending: Deque[Future] = deque()
+        mapped = 0
+        for chunk in itertools.chain((first, second), chunk_iter):
+            pending.append(executor.submit(summarize_chunk, chunk))
+            mapped += 1
+            if len(pending) >= max_workers * 2:
+                partials.append(pending.popleft().result())
+        partials.extend(future.result() for future in pending)
+
+        chunks = list(chunk_lines(partials, max_tokens))
+        if len(chunks) >= mapped:
+            raise RuntimeError("Частичные выжимки не укладываются в бюджет токенов.")
+        while len(chunks) > 1:
+            partials = list(executor.map(summarize_chunk, chunks))
+            reduced = list(chunk_lines(partials, max_tokens))
+            if len(reduced) >= len(chunks):
+                raise RuntimeError("Частичные выжимки не укладываются в бюджет токенов.")
+            chunks = reduced
+    return combine(chunks[0])
@@ -0,0 +1,146 @@
+"""Persistent on-disk cache of summaries keyed by what was sent to the model."""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+DEFAULT_CACHE_PATH = Path(__file__).with_name("summary_cache.db")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so cosmetic differences do not miss the cache."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(model: str, system_prompt: str, text: str) -> str:
+    """SHA-256 of (model, system prompt, normalized text)."""
+    raw = json.dumps(
+        [model, system_prompt, normalize_text(text)], ensure_ascii=False
+    ).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class SummaryCache:
+    """SQLite-backed summary cache with age- and size-based eviction.
+
+    Entries older than ``max_age`` seconds are treated as missing. Once the
+    cache holds more than ``max_entries`` rows, the least recently used ones
+    are evicted. Hit/miss counters are persisted alongside the entries.
+    Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        max_entries: Optional[int] = None,
+        max_age: Optional[float] = None,
+    ) -> None:
+        self.path = str(path or os.getenv("SUMMARY_CACHE_PATH") or DEFAULT_CACHE_PATH)
+        self.max_entries = max_entries or int(
+            os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "10000")
+        )
+        self.max_age = max_age or float(
+            os.getenv("SUMMARY_CACHE_MAX_AGE_DAYS", "30")
+        ) * 86400
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_summaries_last_used
+                ON summaries(last_used);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+            INSERT OR IGNORE INTO cache_stats (id) VALUES (1);
+            """
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached summary, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM summaries WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age),
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE summaries SET last_used = ? WHERE key = ?", (now, key)
+                )
+            column = "hits" if row else "misses"
+            self._conn.execute(
+                f"UPDATE cache_stats SET {column} = {column} + 1 WHERE id = 1"
+            )
+            self._conn.commit()
+        return row[0] if row else None
+
+    def put(self, key: str, summary: str) -> None:
+        """Store a summary and evict expired / least recently used entries."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, summary, created_at, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, summary, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM summaries WHERE created_at < ?", (now - self.max_age,)
+            )
+            self._conn.execute(
+                """
+                DELETE FROM summaries WHERE key IN (
+                    SELECT key FROM summaries ORDER BY last_used DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def get_or_create(
+        self, model: str, system_prompt: str, text: str, create: Callable[[], str]
+    ) -> str:
+        """Return the cached summary for the request or call ``create`` and store it."""
+        key = cache_key(model, system_prompt, text)
+        summary = self.get(key)
+        if summary is None:
+            summary = create()
+            self.put(key, summary)
+        return summary
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM summaries")
+            self._conn.execute("UPDATE cache_stats SET hits = 0, misses = 0")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Return entry count and lifetime hit/miss counters."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            hits, misses = self._conn.execute(
+                "SELECT hits, misses FROM cache_stats WHERE id = 1"
+            ).fetchone()
+        return {"entries": entries, "hits": hits, "misses": misses}
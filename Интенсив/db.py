@@ -3,89 +3,542 @@
 from __future__ import annotations
 
 import asyncio
-from dataclasses import dataclass
-from typing import Optional
+import contextlib
+import itertools
+import logging
+from operator import itemgetter
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import aiosqlite
 
+from dbconfig import (
+    BUSY_RETRY_DELAY,
+    BUSY_RETRY_MAX_DELAY,
+    CHECKPOINT_SQL,
+    WriteBehindError,
+    busy_timeout_ms,
+    connection_pragmas,
+    is_busy,
+    resolve_db_path,
+)
+from schema import migrate_path
 
-@dataclass
-class MessageRecord:
-    """Container for a message to be stored in the database."""
+logger = logging.getLogger(__name__)
 
+INSERT_MESSAGE_SQL = """
+    INSERT OR IGNORE INTO messages (id, chat_id, sender, text, ts)
+    VALUES (?, ?, ?, ?, ?);
+"""
+
+INSERT_MEDIA_SQL = """
+    INSERT OR IGNORE INTO message_media
+        (chat_id, message_id, kind, file_id, mime_type, size, file_name)
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+SET_MEDIA_BLOB_SQL = """
+    UPDATE message_media SET sha256 = ? WHERE chat_id = ? AND message_id = ?;
+"""
+
+# A new revision only when the text differs from the current one (the latest
+# revision, else the stored message): Telegram also sends "edits" for
+# reactions, view counts and link previews.
+INSERT_REVISION_SQL = """
+    INSERT INTO message_revisions (chat_id, message_id, revision, text, edited_ts)
+    SELECT ?1, ?2, COALESCE((
+        SELECT MAX(revision) FROM message_revisions
+        WHERE chat_id = ?1 AND message_id = ?2
+    ), 0) + 1, ?3, ?4
+    WHERE ?3 IS NOT COALESCE((
+        SELECT text FROM message_revisions
+        WHERE chat_id = ?1 AND message_id = ?2
+        ORDER BY revision DESC LIMIT 1
+    ), (SELECT text FROM messages WHERE chat_id = ?1 AND id = ?2));
+"""
+
+INSERT_TOMBSTONE_SQL = """
+    INSERT OR IGNORE INTO message_tombstones (chat_id, message_id, deleted_ts)
+    VALUES (?, ?, ?);
+"""
+
+# Deletions in private chats and basic groups carry no chat id; the chat
+# is resolved from the stored message, among the chats of the account
+# (a JSON array) that saw the deletion. Ids of other accounts' and the
+# bot's messages collide with these, so the lookup is never unscoped.
+INSERT_PRIVATE_TOMBSTONE_SQL = """
+    INSERT OR IGNORE INTO message_tombstones (chat_id, message_id, deleted_ts)
+    SELECT chat_id, id, ?3 FROM messages
+    WHERE chat_id IN (SELECT value FROM json_each(?2)) AND id = ?1;
+"""
+
+UPDATE_SYNC_STATE_SQL = """
+    INSERT INTO sync_state (chat_id, max_message_id) VALUES (?, ?)
+    ON CONFLICT(chat_id) DO UPDATE
+    SET max_message_id = MAX(max_message_id, excluded.max_message_id);
+"""
+
+UPDATE_BACKFILL_STATE_SQL = """
+    INSERT INTO backfill_state (chat_id, oldest_message_id) VALUES (?, ?)
+    ON CONFLICT(chat_id) DO UPDATE
+    SET oldest_message_id = MIN(oldest_message_id, excluded.oldest_message_id);
+"""
+
+
+class MessageRecord(NamedTuple):
+    """A message to be stored, laid out as ``INSERT_MESSAGE_SQL`` parameters.
+
+    Being a plain tuple (no per-instance ``__dict__``), a record is passed to
+    ``execute``/``executemany`` as is. ``sender`` may be a numeric id; the
+    column's TEXT affinity stores it as text. ``ts`` is the date in epoch
+    seconds (UTC); the ``date`` column derives ISO text from it.
+    """
+
+    message_id: int
+    chat_id: int
+    sender: Union[int, str]
+    text: str
+    ts: int
+
+
+class MediaRecord(NamedTuple):
+    """Media metadata of one message, laid out as ``INSERT_MEDIA_SQL`` parameters.
+
+    ``file_id``, ``mime_type``, ``size`` and ``file_name`` are ``None`` for
+    media without a file (web page previews, polls, locations, ...).
+    """
+
+    chat_id: int
+    message_id: int
+    kind: str
+    file_id: Optional[int]
+    mime_type: Optional[str]
+    size: Optional[int]
+    file_name: Optional[str]
+
+
+class MediaBlobRecord(NamedTuple):
+    """Downloaded content of a message's media, as ``SET_MEDIA_BLOB_SQL`` parameters."""
+
+    sha256: str
+    chat_id: int
     message_id: int
+
+
+class EditRecord(NamedTuple):
+    """New text of an edited message, as ``INSERT_REVISION_SQL`` parameters."""
+
     chat_id: int
-    sender: str
+    message_id: int
     text: str
-    date_iso: str
+    edited_ts: int
+
+
+class DeletionRecord(NamedTuple):
+    """A deleted message of a known chat, as ``INSERT_TOMBSTONE_SQL`` parameters."""
+
+    chat_id: int
+    message_id: int
+    deleted_ts: int
+
+
+class PrivateDeletionRecord(NamedTuple):
+    """A deletion without a chat id, as ``INSERT_PRIVATE_TOMBSTONE_SQL`` parameters.
+
+    Telegram does not tell the chat for private chats and basic groups,
+    whose message ids are unique per account. ``chats`` is a JSON array of
+    that account's chats; the tombstone goes to the one storing the
+    message, and nothing is written if none does.
+    """
+
+    message_id: int
+    chats: str
+    deleted_ts: int
+
+
+class BackfillRecord(NamedTuple):
+    """Backfill progress of a chat, as ``UPDATE_BACKFILL_STATE_SQL`` parameters."""
+
+    chat_id: int
+    oldest_message_id: int
+
+
+# Write-behind queue items: (kind, record). "fetched" messages come from a
+# history fetch (backfill/sync) and advance ``sync_state``; "message" ones
+# arrive live and do not, since older messages of the chat may be missing.
+# Other kinds: "media", "media_blob", "edit", "delete", "delete_private",
+# "backfill".
+WriteOp = Tuple[str, NamedTuple]
+
+WRITE_SQL = {
+    "media": INSERT_MEDIA_SQL,
+    "media_blob": SET_MEDIA_BLOB_SQL,
+    "edit": INSERT_REVISION_SQL,
+    "delete": INSERT_TOMBSTONE_SQL,
+    "delete_private": INSERT_PRIVATE_TOMBSTONE_SQL,
+    "backfill": UPDATE_BACKFILL_STATE_SQL,
+}
 
 
 class Database:
-    """Async wrapper around SQLite to store messages."""
+    """Async wrapper around SQLite to store messages.
+
+    With ``write_behind=True`` :meth:`save_message`, :meth:`save_media`,
+    :meth:`set_media_blob`, :meth:`save_edit`, :meth:`save_deletions` and
+    :meth:`save_private_deletions` only put records on a bounded in-memory queue; a
+    background task commits queued records in a single transaction, in
+    arrival order, once ``batch_size`` records are waiting or
+    ``flush_interval_ms`` has passed, whichever comes first. A batch is
+    never dropped: while another process holds the lock it is retried with
+    backoff, and records that fail for any other reason are raised as
+    :class:`dbconfig.WriteBehindError` from :meth:`flush`/:meth:`close`.
 
-    def __init__(self, path: str = "messages.db") -> None:
-        self.path = path
+    ``path`` defaults to the shared location from :mod:`dbconfig`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        write_behind: bool = False,
+        batch_size: int = 500,
+        flush_interval_ms: int = 200,
+        max_queue_size: int = 10_000,
+    ) -> None:
+        self.path = resolve_db_path(path)
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_queue_size = max_queue_size
         self._conn: Optional[aiosqlite.Connection] = None
         self._lock = asyncio.Lock()
+        self._queue: Optional[asyncio.Queue[WriteOp]] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task[None]] = None
+        self._closing = False
+        # One drainer at a time (the flusher or flush()), so batches are
+        # committed in queue order even while one waits out a busy lock.
+        self._drain_lock = asyncio.Lock()
+        self._failed: List[WriteOp] = []
+        self._failure: Optional[BaseException] = None
 
     async def connect(self) -> None:
-        """Open a connection and ensure schema exists."""
-        self._conn = await aiosqlite.connect(self.path)
-        await self._conn.execute("PRAGMA journal_mode=WAL;")
+        """Open a connection and migrate the schema to the latest version."""
+        await asyncio.to_thread(migrate_path, self.path)
+        self._conn = await aiosqlite.connect(
+            self.path, timeout=busy_timeout_ms() / 1000
+        )
+        for pragma in connection_pragmas():
+            await self._conn.execute(pragma)
         await self._conn.execute("PRAGMA foreign_keys=ON;")
-        await self._conn.execute("PRAGMA synchronous=NORMAL;")
-        await self._create_schema()
+        if self.write_behind:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._batch_ready = asyncio.Event()
+            self._closing = False
+            self._flusher = asyncio.create_task(self._flush_loop())
 
     async def close(self) -> None:
-        """Close the database connection."""
-        if self._conn:
-            await self._conn.close()
-            self._conn = None
+        """Drain pending writes and close the database connection.
 
-    async def _create_schema(self) -> None:
-        assert self._conn is not None
-        await self._conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY,
-                chat_id INTEGER NOT NULL,
-                sender TEXT NOT NULL,
-                text TEXT NOT NULL,
-                date TEXT NOT NULL
-            );
-            """
-        )
-        await self._conn.commit()
+        The connection is closed even if some queued records could not be
+        written; the :class:`dbconfig.WriteBehindError` is raised afterwards.
+        """
+        try:
+            if self._flusher:
+                try:
+                    await self.flush()
+                finally:
+                    # Stopped by a flag rather than cancel(): before Python
+                    # 3.12, wait_for() can swallow a cancellation that races
+                    # with its timeout, and close() would wait forever.
+                    assert self._batch_ready is not None
+                    self._closing = True
+                    self._batch_ready.set()
+                    await self._flusher
+                    self._flusher = None
+        finally:
+            if self._conn:
+                await self._conn.execute(CHECKPOINT_SQL)
+                await self._conn.close()
+                self._conn = None
 
-    async def save_message(self, record: MessageRecord) -> bool:
-        """Persist a message if it is not already stored.
+    @contextlib.asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Hold the write lock for one transaction: commit, or roll back on error.
 
-        Returns True if inserted, False if duplicate.
+        Without the rollback a failed statement would leave its transaction
+        open and the next commit would save half of the failed batch.
         """
         assert self._conn is not None
         async with self._lock:
-            cursor = await self._conn.execute(
-                "SELECT 1 FROM messages WHERE id = ? LIMIT 1;",
-                (record.message_id,),
-            )
-            row = await cursor.fetchone()
+            try:
+                yield self._conn
+                await self._conn.commit()
+            except BaseException:
+                await self._conn.rollback()
+                raise
+
+    async def save_message(self, record: MessageRecord) -> bool:
+        """Persist a live message if it is not already stored.
+
+        The chat's high-water mark is left alone: a live message says
+        nothing about the messages before it, and moving the mark would
+        make the next ``sync`` skip a gap left by downtime.
+
+        Returns True if inserted, False if duplicate. In write-behind mode the
+        record is only queued, so True means "accepted"; duplicates are
+        dropped silently when the batch is committed.
+        """
+        if self._queue is not None:
+            await self._enqueue("message", record)
+            return True
+
+        async with self._transaction() as conn:
+            cursor = await conn.execute(INSERT_MESSAGE_SQL, record)
+            inserted = cursor.rowcount > 0
             await cursor.close()
-            if row:
-                return False
-
-            await self._conn.execute(
-                """
-                INSERT INTO messages (id, chat_id, sender, text, date)
-                VALUES (?, ?, ?, ?, ?);
-                """,
-                (
-                    record.message_id,
-                    record.chat_id,
-                    record.sender,
-                    record.text,
-                    record.date_iso,
-                ),
+        return inserted
+
+    async def save_messages(self, records: Iterable[MessageRecord]) -> int:
+        """Insert a batch fetched from history in one transaction, skipping duplicates.
+
+        The per-chat high-water marks in ``sync_state`` are advanced in the
+        same transaction. Returns the number of rows actually inserted.
+        """
+        records = list(records)
+        if not records:
+            return 0
+        async with self._transaction():
+            inserted = await self._insert_messages(records)
+        return inserted
+
+    async def save_edit(self, record: EditRecord) -> None:
+        """Store the new text of an edited message as its next revision.
+
+        Nothing is written if the text did not change. In write-behind mode
+        the record goes through the same queue as new messages, so an edit
+        is applied after the message it edits.
+        """
+        await self._write("edit", [record])
+
+    async def save_deletions(self, records: Iterable[DeletionRecord]) -> None:
+        """Mark messages as deleted; the messages themselves are kept."""
+        await self._write("delete", list(records))
+
+    async def save_private_deletions(
+        self, records: Iterable[PrivateDeletionRecord]
+    ) -> None:
+        """Mark messages deleted in one of the given chats, whichever stores them.
+
+        Queued behind new messages, so a message deleted right after it
+        arrived is already stored when its chat is looked up.
+        """
+        await self._write("delete_private", list(records))
+
+    async def save_backfill_progress(self, record: BackfillRecord) -> None:
+        """Record the oldest message a chat's backfill has stored.
+
+        Written after the batch it describes, so the recorded id is never
+        below what is actually in the database.
+        """
+        await self._write("backfill", [record])
+
+    async def _write(self, kind: str, records: List[NamedTuple]) -> None:
+        if self._queue is not None:
+            for record in records:
+                await self._enqueue(kind, record)
+            return
+        await self.apply([(kind, record) for record in records])
+
+    async def _enqueue(self, kind: str, record: NamedTuple) -> None:
+        assert self._queue is not None
+        await self._queue.put((kind, record))
+        if self._queue.qsize() >= self.batch_size:
+            assert self._batch_ready is not None
+            self._batch_ready.set()
+
+    async def apply(self, ops: Sequence[WriteOp]) -> int:
+        """Write ``(kind, record)`` operations in order in one transaction.
+
+        This is what the write-behind queue drains into, and what a process
+        writing on behalf of others (``supervisor.py``) calls directly.
+        Consecutive operations of the same kind go to one ``executemany``.
+        Returns the number of messages actually inserted.
+        """
+        inserted = 0
+        async with self._transaction() as conn:
+            for kind, group in itertools.groupby(ops, key=itemgetter(0)):
+                records = [record for _, record in group]
+                if kind in ("message", "fetched"):
+                    inserted += await self._insert_messages(
+                        records, advance=kind == "fetched"
+                    )
+                else:
+                    await conn.executemany(WRITE_SQL[kind], records)
+        return inserted
+
+    async def _insert_messages(
+        self, records: List[MessageRecord], *, advance: bool = True
+    ) -> int:
+        """Insert messages and, if ``advance``, ``sync_state``; the caller commits."""
+        assert self._conn is not None
+        # rowcount excludes rows touched by the stats/FTS triggers,
+        # which total_changes would count as well.
+        cursor = await self._conn.executemany(INSERT_MESSAGE_SQL, records)
+        inserted = cursor.rowcount
+        await cursor.close()
+        if not advance:
+            return inserted
+        high_water: Dict[int, int] = {}
+        for record in records:
+            if record.message_id > high_water.get(record.chat_id, 0):
+                high_water[record.chat_id] = record.message_id
+        await self._conn.executemany(UPDATE_SYNC_STATE_SQL, high_water.items())
+        return inserted
+
+    async def save_media(self, records: Iterable[MediaRecord]) -> None:
+        """Store media metadata, skipping messages that already have it.
+
+        In write-behind mode the records are queued behind the messages
+        they belong to instead of committing a transaction per message.
+        """
+        await self._write("media", list(records))
+
+    async def find_blob(self, file_id: int) -> Optional[str]:
+        """Return the sha256 of an already downloaded file with this id."""
+        assert self._conn is not None
+        cursor = await self._conn.execute(
+            "SELECT sha256 FROM message_media "
+            "WHERE file_id = ? AND sha256 IS NOT NULL LIMIT 1;",
+            (file_id,),
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0] if row else None
+
+    async def set_media_blob(self, chat_id: int, message_id: int, sha256: str) -> None:
+        """Record where the downloaded content of a message's media is stored.
+
+        Queued like :meth:`save_media`, so it lands after the metadata row.
+        """
+        await self._write("media_blob", [MediaBlobRecord(sha256, chat_id, message_id)])
+
+    async def get_high_water(self, chat_id: int) -> Optional[int]:
+        """Return the highest stored message id for a chat, if any."""
+        assert self._conn is not None
+        cursor = await self._conn.execute(
+            "SELECT max_message_id FROM sync_state WHERE chat_id = ?;", (chat_id,)
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0] if row else None
+
+    async def get_backfill_offset(self, chat_id: int) -> Optional[int]:
+        """Return the oldest message id a backfill of the chat has stored, if any."""
+        assert self._conn is not None
+        cursor = await self._conn.execute(
+            "SELECT oldest_message_id FROM backfill_state WHERE chat_id = ?;",
+            (chat_id,),
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0] if row else None
+
+    async def get_sync_state(self) -> Dict[int, int]:
+        """Return ``{chat_id: max_message_id}`` for every tracked chat."""
+        assert self._conn is not None
+        cursor = await self._conn.execute(
+            "SELECT chat_id, max_message_id FROM sync_state;"
+        )
+        rows = await cursor.fetchall()
+        await cursor.close()
+        return {chat_id: max_id for chat_id, max_id in rows}
+
+    async def flush(self) -> None:
+        """Commit everything queued so far (no-op outside write-behind mode).
+
+        Raises :class:`dbconfig.WriteBehindError` with the records that
+        could not be written since the last flush.
+        """
+        if self._queue is None:
+            return
+        await self._drain()
+        # A batch taken by the flusher may still be in flight.
+        await self._queue.join()
+        if self._failed:
+            failed, self._failed = self._failed, []
+            raise WriteBehindError(failed, self._failure)
+
+    async def _flush_loop(self) -> None:
+        assert self._batch_ready is not None
+        while not self._closing:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            self._batch_ready.clear()
+            await self._drain()
+
+    async def _drain(self) -> None:
+        assert self._queue is not None
+        async with self._drain_lock:
+            while not self._queue.empty():
+                batch: List[WriteOp] = []
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                try:
+                    inserted = await self._write_batch(batch)
+                    logger.debug("Flushed %d records (%d new)", len(batch), inserted)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+
+    async def _write_batch(self, batch: List[WriteOp]) -> int:
+        """Commit a drained batch without silently losing any of it.
+
+        If the batch fails for a reason other than a busy database, it is
+        written again one record per transaction, so one bad record does
+        not cost the others; the records that still fail are kept for
+        :meth:`flush` to raise.
+        """
+        try:
+            return await self._apply_when_free(batch)
+        except Exception:
+            logger.exception(
+                "Failed to flush %d queued records, retrying one by one", len(batch)
             )
-            await self._conn.commit()
-            return True
+        inserted = 0
+        for op in batch:
+            try:
+                inserted += await self._apply_when_free([op])
+            except Exception as exc:
+                logger.error("Could not write queued %s %r: %s", op[0], op[1], exc)
+                self._failed.append(op)
+                self._failure = exc
+        return inserted
+
+    async def _apply_when_free(self, ops: Sequence[WriteOp]) -> int:
+        """:meth:`apply`, retried with backoff while another process holds the lock.
 
+        The queue keeps filling meanwhile and blocks producers once full, so
+        a long lock slows ingestion down instead of losing records.
+        """
+        delay = BUSY_RETRY_DELAY
+        while True:
+            try:
+                return await self.apply(ops)
+            except Exception as exc:
+                if not is_busy(exc):
+                    raise
+                logger.warning(
+                    "Database busy, retrying %d queued records in %.1f s", len(ops), delay
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BUSY_RETRY_MAX_DELAY)
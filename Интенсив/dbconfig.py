@@ -0,0 +1,148 @@
+"""Shared location and connection policy for the messages database.
+
+The collector, the bot, the Flask dashboard and the AI CLI run as separate
+processes against one SQLite file. All of them resolve the path and open
+their connections through this module, so they agree on the file, on WAL
+mode, on how long to wait for a lock and on when the WAL is checkpointed.
+
+Settings (environment, read each time a connection is opened, so values
+from a ``.env`` loaded after import still apply):
+
+``MESSAGES_DB_PATH``
+    Path to the database. Default: ``messages.db`` next to this module.
+``SQLITE_BUSY_TIMEOUT_MS``
+    How long a connection waits for another process's lock before failing
+    with "database is locked".
+``SQLITE_WAL_AUTOCHECKPOINT``
+    WAL size (pages) after which a committing writer checkpoints it.
+``SQLITE_JOURNAL_SIZE_LIMIT``
+    Size (bytes) the WAL file is truncated to after a checkpoint.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, List, Optional, Union
+
+DB_PATH_ENV = "MESSAGES_DB_PATH"
+DEFAULT_DB_PATH = Path(__file__).resolve().parent / "messages.db"
+
+DEFAULT_BUSY_TIMEOUT_MS = 10_000
+DEFAULT_WAL_AUTOCHECKPOINT_PAGES = 1000
+DEFAULT_JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+CHECKPOINT_SQL = "PRAGMA wal_checkpoint(TRUNCATE);"
+
+# Backoff (seconds) of a write-behind batch retried while the file is locked.
+BUSY_RETRY_DELAY = 0.1
+BUSY_RETRY_MAX_DELAY = 5.0
+
+
+class WriteBehindError(RuntimeError):
+    """Queued writes that could not be committed.
+
+    Raised from ``flush()``/``close()`` of a write-behind writer; ``records``
+    are the rejected queue items, so the caller can log or retry them.
+    """
+
+    def __init__(self, records: List[Any], cause: Optional[BaseException]) -> None:
+        super().__init__(f"{len(records)} queued records were not written: {cause}")
+        self.records = records
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def busy_timeout_ms() -> int:
+    """How long to wait for another connection's lock, in milliseconds."""
+    return _env_int("SQLITE_BUSY_TIMEOUT_MS", DEFAULT_BUSY_TIMEOUT_MS)
+
+
+def is_busy(exc: BaseException) -> bool:
+    """True for "database is locked"/busy errors, which are worth retrying."""
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+def resolve_db_path(path: Optional[Union[str, Path]] = None) -> str:
+    """Return the database path to use.
+
+    An explicit ``path`` (e.g. from ``--db``) wins, then ``$MESSAGES_DB_PATH``,
+    then ``messages.db`` in the collector's folder, so every process finds
+    the same file regardless of its working directory.
+    """
+    chosen = path or os.getenv(DB_PATH_ENV) or DEFAULT_DB_PATH
+    return str(Path(chosen).expanduser())
+
+
+def connection_pragmas(*, readonly: bool = False) -> List[str]:
+    """PRAGMA statements every connection runs right after opening.
+
+    Writers switch the file to WAL (a no-op once it is), so readers never
+    block them and vice versa; ``synchronous=NORMAL`` is durable enough in
+    WAL mode. Autocheckpoint plus the journal size limit keep the WAL from
+    growing without bound while the collector ingests continuously.
+    """
+    pragmas = [f"PRAGMA busy_timeout={busy_timeout_ms()};"]
+    if readonly:
+        return pragmas + ["PRAGMA query_only=1;"]
+    autocheckpoint = _env_int(
+        "SQLITE_WAL_AUTOCHECKPOINT", DEFAULT_WAL_AUTOCHECKPOINT_PAGES
+    )
+    size_limit = _env_int("SQLITE_JOURNAL_SIZE_LIMIT", DEFAULT_JOURNAL_SIZE_LIMIT)
+    return pragmas + [
+        "PRAGMA journal_mode=WAL;",
+        "PRAGMA synchronous=NORMAL;",
+        f"PRAGMA wal_autocheckpoint={autocheckpoint};",
+        f"PRAGMA journal_size_limit={size_limit};",
+    ]
+
+
+def configure(conn: sqlite3.Connection, *, readonly: bool = False) -> None:
+    """Apply :func:`connection_pragmas` to an open connection."""
+    for pragma in connection_pragmas(readonly=readonly):
+        conn.execute(pragma)
+
+
+def connect(
+    path: Optional[Union[str, Path]] = None,
+    *,
+    readonly: bool = False,
+    check_same_thread: bool = True,
+) -> sqlite3.Connection:
+    """Open the messages database with the shared policy applied.
+
+    ``readonly`` connections are opened through a ``mode=ro`` URI and fail
+    if the file does not exist instead of creating an empty database.
+    """
+    resolved = resolve_db_path(path)
+    timeout = busy_timeout_ms() / 1000
+    if readonly:
+        conn = sqlite3.connect(
+            f"{Path(resolved).resolve().as_uri()}?mode=ro",
+            uri=True,
+            timeout=timeout,
+            check_same_thread=check_same_thread,
+        )
+    else:
+        conn = sqlite3.connect(
+            resolved, timeout=timeout, check_same_thread=check_same_thread
+        )
+    configure(conn, readonly=readonly)
+    return conn
+
+
+def checkpoint(conn: sqlite3.Connection) -> None:
+    """Checkpoint and truncate the WAL; long-lived writers call it on close.
+
+    If a reader still holds an old snapshot after the busy timeout, the
+    checkpoint stops short instead of failing; a later one finishes the job.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute(CHECKPOINT_SQL).fetchone()
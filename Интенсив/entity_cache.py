@@ -0,0 +1,65 @@
+"""In-process LRU cache of chat entities for the live listener."""
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from telethon.tl.custom import Dialog
+
+
+class EntityCache:
+    """Map ``chat_id`` to its Telethon entity with LRU eviction and a TTL.
+
+    Entries older than ``ttl`` seconds count as misses, so the caller
+    refetches them and titles eventually pick up renames.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 4096,
+        ttl: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[int, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, chat_id: int) -> Optional[Any]:
+        """Return a fresh cached entity or None, counting a hit or a miss."""
+        entry = self._entries.get(chat_id)
+        if entry is not None and self._clock() - entry[0] < self.ttl:
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[chat_id]
+        self.misses += 1
+        return None
+
+    def put(self, chat_id: int, entity: Any) -> None:
+        self._entries[chat_id] = (self._clock(), entity)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def warm(self, dialogs: Iterable[Dialog]) -> None:
+        """Pre-fill the cache from a ``list_dialogs`` result."""
+        for dialog in dialogs:
+            self.put(dialog.id, dialog.entity)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,45 +1,129 @@
 """Flask web application for displaying Telegram messages statistics."""
 
+import base64
+import json
 import os
+import queue
 import sqlite3
-from datetime import datetime
+import sys
+import threading
+from datetime import datetime, timezone
 from pathlib import Path
 
-from flask import Flask, render_template
+from flask import Flask, abort, g, jsonify, render_template, request
+from markupsafe import Markup, escape
+
+# Миграции схемы лежат рядом с main.py (на уровень выше от flask/)
+sys.path.append(str(Path(__file__).parent.parent))
+from dbconfig import connect, resolve_db_path  # noqa: E402
+from schema import migrate  # noqa: E402
 
 app = Flask(__name__)
 
-# Путь к базе данных (на уровень выше от flask/)
-DB_PATH = Path(__file__).parent.parent / "messages.db"
+# Путь к базе данных: $MESSAGES_DB_PATH или messages.db на уровень выше от flask/
+DB_PATH = Path(resolve_db_path())
+
+
+# Настройки read-only соединений дашборда
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "16384"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
 
 
 def init_db():
-    """Инициализировать базу данных, создав таблицу, если её нет."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    """Инициализировать базу данных и применить миграции схемы.
+
+    Вызывается один раз при старте приложения. Включает WAL (общие для
+    всех процессов настройки из dbconfig), чтобы читатели дашборда не
+    блокировали коллектор и наоборот.
+    """
+    conn = connect(DB_PATH)
     try:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY,
-                chat_id INTEGER NOT NULL,
-                sender TEXT NOT NULL,
-                text TEXT NOT NULL,
-                date TEXT NOT NULL
-            );
-            """
-        )
-        conn.commit()
+        migrate(conn)
     finally:
         conn.close()
 
 
+class ReadOnlyConnectionPool:
+    """Общий для процесса пул read-only соединений SQLite.
+
+    `app.run` обслуживает каждый запрос в новом потоке, поэтому пул не
+    привязан к потокам: соединения открываются с `check_same_thread=False`
+    и хранятся в общей очереди. Свободные соединения выдаются в порядке
+    LIFO — последнее возвращённое, с самым прогретым кэшем страниц.
+    Открыто не больше `max_size` соединений; если все заняты, запрос ждёт
+    освобождения до `timeout` секунд.
+    """
+
+    def __init__(self, path, max_size=8, timeout=10.0):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def _connect(self):
+        conn = connect(self.path, readonly=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KIB};")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE};")
+        return conn
+
+    def acquire(self):
+        """Взять свободное соединение, открыть новое или дождаться освобождения.
+
+        Raises:
+            TimeoutError: Все `max_size` соединений заняты дольше `timeout`.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.max_size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("нет свободных соединений с базой") from None
+
+    def release(self, conn):
+        """Вернуть соединение в пул (незавершённая транзакция откатывается)."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+
+# Схема проверяется один раз при старте, а не на каждый запрос
+init_db()
+pool = ReadOnlyConnectionPool(DB_PATH, max_size=SQLITE_POOL_SIZE)
+
+
 def get_db_connection():
-    """Создать подключение к базе данных SQLite."""
-    # Убеждаемся, что таблица существует
-    init_db()
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Соединение для текущего запроса (одно на app context)."""
+    if "db" not in g:
+        try:
+            g.db = pool.acquire()
+        except TimeoutError:
+            abort(503)
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """Вернуть соединение запроса в пул по окончании app context."""
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn)
 
 
 @app.route("/")
@@ -48,22 +132,21 @@ def index():
     conn = get_db_connection()
     
     try:
-        # Всего сообщений
-        total_count = conn.execute("SELECT COUNT(*) as count FROM messages").fetchone()["count"]
+        # Счётчики поддерживаются триггерами: одна строка вместо COUNT(*)
+        row = conn.execute(
+            "SELECT total_messages, processed_messages, latest_date FROM stats WHERE id = 1"
+        ).fetchone()
+        total_count = row["total_messages"] if row else 0
         
-        # Проанализировано (все сообщения в базе считаются проанализированными)
-        analyzed_count = total_count
+        # Проанализировано (помечено ботом как обработанное)
+        analyzed_count = row["processed_messages"] if row else 0
         
         # Последняя выжимка (дата последнего сообщения)
-        last_message = conn.execute(
-            "SELECT date FROM messages ORDER BY date DESC LIMIT 1"
-        ).fetchone()
-        
         last_extraction = None
-        if last_message:
+        if row and row["latest_date"]:
             try:
                 # Парсим ISO формат даты
-                last_extraction = datetime.fromisoformat(last_message["date"])
+                last_extraction = datetime.fromisoformat(row["latest_date"])
             except (ValueError, TypeError):
                 last_extraction = None
         
@@ -82,48 +165,344 @@ def index():
             "last_extraction": None,
         }
         return render_template("index.html", stats=stats)
-    finally:
-        conn.close()
+
+
+# Размер страницы по умолчанию и верхняя граница для ?limit=
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(ts, rowid):
+    """Упаковать позицию (ts, rowid) последней строки страницы в строку."""
+    raw = json.dumps([ts, rowid], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Распаковать курсор; None для первой страницы, ValueError для мусора."""
+    if not cursor:
+        return None
+    try:
+        ts, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError) as exc:
+        raise ValueError("некорректный курсор") from exc
+    if not isinstance(ts, int) or not isinstance(rowid, int):
+        raise ValueError("некорректный курсор")
+    return ts, rowid
+
+
+def parse_date(value):
+    """ISO-дата из фильтра в секунды Unix; дата без часового пояса — UTC."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise ValueError(f"некорректная дата: {value}") from exc
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def parse_message_filters(args):
+    """Прочитать фильтры chat_id / sender / since / until из query string.
+
+    since/until остаются строками (для формы); в запросе они сравниваются
+    с ts после parse_date, поэтому некорректная дата даёт ValueError сразу.
+    """
+    filters = {}
+    chat_id = args.get("chat_id", "").strip()
+    if chat_id:
+        try:
+            filters["chat_id"] = int(chat_id)
+        except ValueError as exc:
+            raise ValueError("chat_id должен быть числом") from exc
+    for key in ("sender", "since", "until"):
+        value = args.get(key, "").strip()
+        if value:
+            if key != "sender":
+                parse_date(value)
+            filters[key] = value
+    return filters
+
+
+# Текущее состояние сообщения m: текст последней правки, число правок и время
+# удаления. Каждое поле — поиск по первичному ключу (chat_id, message_id, ...)
+# только для строк страницы, история правок не просматривается.
+CURRENT_STATE_COLUMNS = """
+    COALESCE((
+        SELECT r.text FROM message_revisions AS r
+        WHERE r.chat_id = m.chat_id AND r.message_id = m.id
+        ORDER BY r.revision DESC LIMIT 1
+    ), m.text) AS text,
+    (
+        SELECT MAX(r.revision) FROM message_revisions AS r
+        WHERE r.chat_id = m.chat_id AND r.message_id = m.id
+    ) AS edits,
+    (
+        SELECT t.deleted_ts FROM message_tombstones AS t
+        WHERE t.chat_id = m.chat_id AND t.message_id = m.id
+        LIMIT 1
+    ) AS deleted_ts
+"""
+
+
+def fetch_messages_page(conn, filters, cursor=None, limit=PAGE_SIZE):
+    """Одна страница сообщений (новые сверху) с keyset-пагинацией по (ts, rowid).
+
+    Вместо OFFSET следующая страница начинается строго после последней
+    строки предыдущей, поэтому запрос идёт по индексу `ts` или
+    `(chat_id, ts)` и стоит одинаково на любой глубине. Даты сравниваются
+    как целые секунды Unix, поэтому порядок не зависит от формата,
+    в котором их записал источник.
+
+    Текст — текущий (с учётом правок), `edits` — число правок или None,
+    `deleted_ts` — время удаления или None (см. CURRENT_STATE_COLUMNS).
+
+    Returns:
+        Кортеж (строки, курсор следующей страницы или None).
+    """
+    where = []
+    params = []
+    if "chat_id" in filters:
+        where.append("chat_id = ?")
+        params.append(filters["chat_id"])
+    if "sender" in filters:
+        where.append("sender = ?")
+        params.append(filters["sender"])
+    if "since" in filters:
+        where.append("ts >= ?")
+        params.append(parse_date(filters["since"]))
+    if "until" in filters:
+        where.append("ts < ?")
+        params.append(parse_date(filters["until"]))
+    if cursor is not None:
+        where.append("(ts, rowid) < (?, ?)")
+        params.extend(cursor)
+
+    sql = (
+        "SELECT m.rowid, m.id, m.chat_id, m.sender, m.ts, "
+        + CURRENT_STATE_COLUMNS
+        + " FROM messages AS m"
+    )
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts DESC, rowid DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["ts"], rows[-1]["rowid"])
+    return rows, next_cursor
+
+
+def read_page_request(args):
+    """Разобрать фильтры, курсор и limit запроса; ValueError при ошибке."""
+    filters = parse_message_filters(args)
+    cursor = decode_cursor(args.get("cursor"))
+    limit = args.get("limit", PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return filters, cursor, limit
+
+
+def ts_to_datetime(ts):
+    """Секунды Unix из БД в datetime (UTC)."""
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+@app.template_filter("datetime")
+def format_ts(ts, fmt="%Y-%m-%d %H:%M:%S"):
+    """Jinja-фильтр: {{ msg.ts | datetime }} — дата сообщения для таблицы."""
+    if ts is None:
+        return "N/A"
+    return ts_to_datetime(ts).strftime(fmt)
 
 
 @app.route("/messages")
 def messages():
-    """Страница со списком всех сообщений."""
+    """Страница со списком сообщений (по PAGE_SIZE на страницу)."""
+    try:
+        filters, cursor, limit = read_page_request(request.args)
+    except ValueError as exc:
+        abort(400, description=str(exc))
+
     conn = get_db_connection()
     
     try:
-        # Получаем все сообщения, отсортированные по дате (новые сверху)
-        messages_list = conn.execute(
-            """
-            SELECT id, chat_id, sender, text, date 
-            FROM messages 
-            ORDER BY date DESC
-            """
-        ).fetchall()
+        rows, next_cursor = fetch_messages_page(conn, filters, cursor, limit)
         
-        # Преобразуем Row объекты в словари для удобства в шаблоне
-        messages_data = []
-        for msg in messages_list:
-            try:
-                date_obj = datetime.fromisoformat(msg["date"])
-                formatted_date = date_obj.strftime("%Y-%m-%d %H:%M:%S")
-            except (ValueError, TypeError):
-                formatted_date = msg["date"] or "N/A"
-            
-            messages_data.append({
+        # Дату форматирует шаблон (фильтр datetime)
+        return render_template(
+            "messages.html",
+            messages=rows,
+            filters=filters,
+            next_cursor=next_cursor,
+            is_first_page=cursor is None,
+        )
+    except sqlite3.OperationalError:
+        # Если таблицы нет, возвращаем пустой список
+        return render_template(
+            "messages.html",
+            messages=[],
+            filters=filters,
+            next_cursor=None,
+            is_first_page=True,
+        )
+
+
+@app.route("/api/messages")
+def api_messages():
+    """JSON-версия /messages: те же фильтры, курсор и limit."""
+    try:
+        filters, cursor, limit = read_page_request(request.args)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    conn = get_db_connection()
+    rows, next_cursor = fetch_messages_page(conn, filters, cursor, limit)
+    return jsonify({
+        "messages": [
+            {
                 "id": msg["id"],
                 "chat_id": msg["chat_id"],
                 "sender": msg["sender"],
                 "text": msg["text"],
-                "date": formatted_date,
+                "ts": msg["ts"],
+                "date": ts_to_datetime(msg["ts"]).isoformat(),
+                "edits": msg["edits"] or 0,
+                "deleted": msg["deleted_ts"] is not None,
+            }
+            for msg in rows
+        ],
+        "next_cursor": next_cursor,
+    })
+
+
+# Маркеры подсветки в snippet(): заменяются на <mark> после экранирования
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+
+
+def build_fts_query(raw):
+    """Превратить пользовательский ввод в безопасный запрос FTS5.
+
+    Каждое слово берётся в кавычки (операторы FTS5 в вводе не работают)
+    и ищется по префиксу; слова объединяются через AND.
+    """
+    terms = [term.replace('"', '""') for term in raw.split()]
+    return " ".join(f'"{term}"*' for term in terms if term)
+
+
+def highlight_snippet(snippet):
+    """Экранировать HTML в сниппете и подсветить совпадения тегом <mark>."""
+    escaped = str(escape(snippet or ""))
+    return Markup(
+        escaped.replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+    )
+
+
+def search_messages(conn, query, chat_id=None, page=1, limit=PAGE_SIZE):
+    """Полнотекстовый поиск по messages_fts, лучшие совпадения (bm25) сверху.
+
+    Индекс и сниппет — по текущему тексту (с учётом правок), `deleted_ts` —
+    время удаления или None.
+
+    Returns:
+        Кортеж (строки, есть ли следующая страница).
+    """
+    sql = f"""
+        SELECT m.id, m.chat_id, m.sender, m.ts,
+               snippet(messages_fts, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 16)
+                   AS snippet,
+               t.deleted_ts
+        FROM messages_fts
+        JOIN messages AS m ON m.rowid = messages_fts.rowid
+        LEFT JOIN message_tombstones AS t
+            ON t.chat_id = m.chat_id AND t.message_id = m.id
+        WHERE messages_fts MATCH ?
+    """
+    params = [query]
+    if chat_id is not None:
+        sql += " AND m.chat_id = ?"
+        params.append(chat_id)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params.extend([limit + 1, (page - 1) * limit])
+
+    rows = conn.execute(sql, params).fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def read_search_request(args):
+    """Разобрать q, chat_id, page и limit запроса поиска; ValueError при ошибке."""
+    query = build_fts_query(args.get("q", ""))
+    chat_id = parse_message_filters(args).get("chat_id")
+    page = max(1, args.get("page", 1, type=int))
+    limit = max(1, min(args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    return query, chat_id, page, limit
+
+
+@app.route("/search")
+def search():
+    """Страница полнотекстового поиска по сообщениям."""
+    try:
+        query, chat_id, page, limit = read_search_request(request.args)
+    except ValueError as exc:
+        abort(400, description=str(exc))
+
+    results = []
+    has_next = False
+    if query:
+        rows, has_next = search_messages(
+            get_db_connection(), query, chat_id, page, limit
+        )
+        for row in rows:
+            results.append({
+                "id": row["id"],
+                "chat_id": row["chat_id"],
+                "sender": row["sender"],
+                "snippet": highlight_snippet(row["snippet"]),
+                "ts": row["ts"],
+                "deleted_ts": row["deleted_ts"],
             })
-        
-        return render_template("messages.html", messages=messages_data)
-    except sqlite3.OperationalError:
-        # Если таблицы нет, возвращаем пустой список
-        return render_template("messages.html", messages=[])
-    finally:
-        conn.close()
+
+    return render_template(
+        "search.html",
+        q=request.args.get("q", ""),
+        chat_id=chat_id,
+        results=results,
+        page=page,
+        has_next=has_next,
+    )
+
+
+@app.route("/api/search")
+def api_search():
+    """JSON-версия /search. snippet — HTML с экранированным текстом и <mark>."""
+    try:
+        query, chat_id, page, limit = read_search_request(request.args)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if not query:
+        return jsonify({"error": "параметр q обязателен"}), 400
+
+    rows, has_next = search_messages(get_db_connection(), query, chat_id, page, limit)
+    return jsonify({
+        "results": [
+            {
+                "id": row["id"],
+                "chat_id": row["chat_id"],
+                "sender": row["sender"],
+                "ts": row["ts"],
+                "date": ts_to_datetime(row["ts"]).isoformat(),
+                "snippet": str(highlight_snippet(row["snippet"])),
+                "deleted": row["deleted_ts"] is not None,
+                "deleted_ts": row["deleted_ts"],
+            }
+            for row in rows
+        ],
+        "page": page,
+        "next_page": page + 1 if has_next else None,
+    })
 
 
 if __name__ == "__main__":
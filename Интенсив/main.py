@@ -1,16 +1,32 @@
 """Example Telethon client with SQLite persistence."""
 
+import argparse
 import asyncio
+import contextlib
+import json
 import logging
-from typing import List, Optional
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, List, Optional, Sequence, Set
 
 from telethon import TelegramClient, events
 from telethon.errors.rpcerrorlist import FloodWaitError
 from telethon.tl.custom import Dialog
 from telethon.tl.custom.message import Message
+from telethon.utils import get_display_name
 
 import config
-from db import Database, MessageRecord
+from db import (
+    BackfillRecord,
+    Database,
+    DeletionRecord,
+    EditRecord,
+    MessageRecord,
+    PrivateDeletionRecord,
+)
+from dbconfig import resolve_db_path
+from entity_cache import EntityCache
+from media import BlobStore, MediaCapture
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +34,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("telethon-app")
 
+# How often (seconds) the live listener logs entity cache hits and misses.
+CACHE_STATS_INTERVAL = 600.0
+
 
 async def list_dialogs(client: TelegramClient) -> List[Dialog]:
     """Fetch available dialogs (chats, channels, PMs)."""
@@ -27,52 +46,311 @@ async def list_dialogs(client: TelegramClient) -> List[Dialog]:
     return dialogs
 
 
-async def fetch_recent_messages(
-    client: TelegramClient, chat: Dialog, limit: int
-) -> List[Message]:
-    """Collect the latest N messages from the selected chat."""
-    messages: List[Message] = []
-    async for message in client.iter_messages(chat.id, limit=limit):
-        messages.append(message)
-    messages.reverse()  # oldest first
-    return messages
+def private_chat_ids(dialogs: Iterable[Dialog]) -> Set[int]:
+    """Ids of private chats and basic groups, whose deletions carry no chat id."""
+    return {dialog.id for dialog in dialogs if not dialog.is_channel}
 
 
-def format_short_log(dialog: Dialog, message: Message) -> str:
+def format_short_log(title: str, message: Message) -> str:
     sender = message.sender_id or "unknown"
     text = (message.text or "").replace("\n", " ")
-    return f"[{dialog.title}] {sender}: {text[:80]}"
+    return f"[{title}] {sender}: {text[:80]}"
 
 
-async def save_message_to_db(db: Database, dialog: Dialog, message: Message) -> None:
-    if message.id is None:
-        return
-    sender_display = str(message.sender_id or "unknown")
-    text = message.message or ""
-    record = MessageRecord(
-        message_id=message.id,
-        chat_id=dialog.id,
-        sender=sender_display,
-        text=text,
-        date_iso=message.date.isoformat() if message.date else "",
+def messages_to_records(
+    chat_id: int, messages: Iterable[Message]
+) -> List[MessageRecord]:
+    """Turn a batch of Telethon messages into ``executemany`` parameter rows.
+
+    Nothing is formatted in Python: the sender id is stored as is (SQLite
+    renders it as text) and the date as epoch seconds.
+    """
+    return [
+        MessageRecord(
+            message.id,
+            chat_id,
+            message.sender_id or "unknown",
+            message.message or "",
+            int(message.date.timestamp()) if message.date else 0,
+        )
+        for message in messages
+        if message.id is not None
+    ]
+
+
+async def save_message_to_db(
+    db: Database,
+    chat_id: int,
+    message: Message,
+    media: Optional[MediaCapture] = None,
+) -> None:
+    for record in messages_to_records(chat_id, (message,)):
+        inserted = await db.save_message(record)
+        if inserted:
+            logger.debug("Stored message %s from chat %s", record.message_id, chat_id)
+    if media is not None:
+        await media.capture(chat_id, (message,))
+
+
+async def save_edit_to_db(db: Database, chat_id: int, message: Message) -> None:
+    """Store an edited message's new text as a revision.
+
+    The message is saved first in case it predates collection; then its
+    stored text already is the edited one and no revision is added.
+    """
+    await save_message_to_db(db, chat_id, message)
+    edited = message.edit_date or message.date
+    await db.save_edit(
+        EditRecord(
+            chat_id,
+            message.id,
+            message.message or "",
+            int(edited.timestamp()) if edited else int(time.time()),
+        )
     )
-    inserted = await db.save_message(record)
-    if inserted:
-        logger.debug("Stored message %s from chat %s", record.message_id, dialog.id)
 
 
-async def run_listener(client: TelegramClient, db: Database) -> None:
-    """Attach a live listener for new messages."""
+async def store_batch(
+    db: Database,
+    chat_id: int,
+    messages: List[Message],
+    media: Optional[MediaCapture] = None,
+) -> None:
+    """Write a batch of fetched messages (and their media, if captured)."""
+    await db.save_messages(messages_to_records(chat_id, messages))
+    if media is not None:
+        await media.capture(chat_id, messages)
+
+
+async def backfill_dialog(
+    client: TelegramClient,
+    db: Database,
+    dialog: Dialog,
+    *,
+    limit: Optional[int] = None,
+    batch_size: int = 500,
+    media: Optional[MediaCapture] = None,
+    resume: bool = True,
+) -> int:
+    """Stream a dialog's history (newest first) into batched DB writes.
+
+    A ``FloodWaitError`` only pauses this dialog: pending records are
+    flushed, then iteration resumes from the oldest message already seen.
+    The oldest stored id is also recorded after every batch, so with
+    ``resume`` a backfill interrupted by a crash continues below it instead
+    of starting from the newest message. Returns the number of messages
+    fetched.
+    """
+
+    async def save(batch: List[Message]) -> None:
+        await store_batch(db, dialog.id, batch, media)
+        if batch:
+            await db.save_backfill_progress(BackfillRecord(dialog.id, batch[-1].id))
+
+    fetched = 0
+    offset_id = (await db.get_backfill_offset(dialog.id) if resume else None) or 0
+    if offset_id:
+        logger.info("Resuming '%s' below message %s", dialog.title, offset_id)
+    batch: List[Message] = []
+    while True:
+        remaining = None if limit is None else limit - fetched
+        if remaining is not None and remaining <= 0:
+            break
+        try:
+            async for message in client.iter_messages(
+                dialog.id, limit=remaining, offset_id=offset_id
+            ):
+                offset_id = message.id
+                fetched += 1
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    await save(batch)
+                    batch = []
+            break
+        except FloodWaitError as exc:
+            await save(batch)
+            batch = []
+            logger.warning(
+                "Flood wait in '%s': sleeping %s s, resuming after message %s",
+                dialog.title,
+                exc.seconds,
+                offset_id,
+            )
+            await asyncio.sleep(exc.seconds + 1)
+    await save(batch)
+    return fetched
+
+
+async def sync_dialog(
+    client: TelegramClient,
+    db: Database,
+    dialog: Dialog,
+    *,
+    initial_limit: int = 100,
+    batch_size: int = 500,
+    media: Optional[MediaCapture] = None,
+) -> int:
+    """Fetch only messages newer than the chat's stored high-water mark.
+
+    Messages arrive oldest first and are committed in order, so the mark in
+    ``sync_state`` always describes a gap-free prefix and an interrupted
+    sync resumes exactly where it stopped. A chat without a mark gets its
+    last ``initial_limit`` messages instead. Returns the number fetched.
+    """
+    min_id = await db.get_high_water(dialog.id)
+    if min_id is None:
+        return await backfill_dialog(
+            client, db, dialog, limit=initial_limit, batch_size=batch_size, media=media
+        )
+
+    fetched = 0
+    batch: List[Message] = []
+    while True:
+        try:
+            async for message in client.iter_messages(
+                dialog.id, min_id=min_id, reverse=True
+            ):
+                fetched += 1
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    await store_batch(db, dialog.id, batch, media)
+                    min_id = batch[-1].id
+                    batch = []
+            break
+        except FloodWaitError as exc:
+            await store_batch(db, dialog.id, batch, media)
+            if batch:
+                min_id = batch[-1].id
+            batch = []
+            logger.warning(
+                "Flood wait in '%s': sleeping %s s, resuming after message %s",
+                dialog.title,
+                exc.seconds,
+                min_id,
+            )
+            await asyncio.sleep(exc.seconds + 1)
+    await store_batch(db, dialog.id, batch, media)
+    return fetched
+
+
+async def run_for_dialogs(
+    dialogs: Sequence[Dialog],
+    job: Callable[[Dialog], Awaitable[int]],
+    *,
+    concurrency: int = 4,
+    action: str = "Backfill",
+) -> None:
+    """Run ``job`` for many dialogs at once, at most ``concurrency`` in parallel.
+
+    A failing dialog is logged and does not stop the others.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(dialog: Dialog) -> None:
+        async with semaphore:
+            logger.info("%s of '%s' (id=%s)...", action, dialog.title, dialog.id)
+            try:
+                count = await job(dialog)
+            except Exception:
+                logger.exception("%s of '%s' failed.", action, dialog.title)
+                return
+            logger.info("%s of '%s': %d messages.", action, dialog.title, count)
+
+    await asyncio.gather(*(worker(dialog) for dialog in dialogs))
 
-    @client.on(events.NewMessage)
+
+def attach_listener(
+    client: TelegramClient,
+    db: Database,
+    cache: EntityCache,
+    media: Optional[MediaCapture] = None,
+    chats: Optional[Sequence[int]] = None,
+    own_chats: Iterable[int] = (),
+) -> None:
+    """Register handlers for new, edited and deleted messages.
+
+    Attach before catching up with ``sync_dialog``: live messages are
+    stored as they arrive but do not move the high-water marks, so the
+    overlap with the catch-up is deduplicated and nothing that arrives
+    in between is lost.
+
+    Chat titles come from ``cache``; ``event.get_chat()`` is only awaited
+    for chats the cache does not know yet (or whose entry expired).
+    ``chats`` limits new, edited and deleted messages to those chats.
+
+    Deletions in private chats and basic groups carry no chat id; they are
+    matched only against this account's chats (``own_chats`` and
+    ``chats``, plus such chats seen by the listener), never against every
+    stored message with the same id.
+    """
+    wanted = None if chats is None else set(chats)
+    scope = set(own_chats) | (wanted or set())
+
+    @client.on(events.NewMessage(chats=chats))
     async def handler(event: events.NewMessage.Event) -> None:
-        dialog = await event.get_chat()
+        chat_id = event.chat_id
+        chat = cache.get(chat_id)
+        if chat is None:
+            chat = await event.get_chat()
+            cache.put(chat_id, chat)
+        if not event.is_channel:
+            scope.add(chat_id)
         message = event.message
-        await save_message_to_db(db, dialog, message)
-        logger.info(format_short_log(dialog, message))
+        await save_message_to_db(db, chat_id, message, media)
+        logger.info(format_short_log(get_display_name(chat), message))
+
+    @client.on(events.MessageEdited(chats=chats))
+    async def edit_handler(event: events.MessageEdited.Event) -> None:
+        await save_edit_to_db(db, event.chat_id, event.message)
+        logger.debug("Message %s in chat %s edited", event.message.id, event.chat_id)
+
+    @client.on(events.MessageDeleted)
+    async def delete_handler(event: events.MessageDeleted.Event) -> None:
+        now = int(time.time())
+        chat_id = event.chat_id
+        if chat_id is None:
+            # Private chat or basic group (see PrivateDeletionRecord).
+            if not scope:
+                return
+            own = json.dumps(sorted(scope))
+            await db.save_private_deletions(
+                PrivateDeletionRecord(message_id, own, now)
+                for message_id in event.deleted_ids
+            )
+        elif wanted is None or chat_id in wanted:
+            await db.save_deletions(
+                DeletionRecord(chat_id, message_id, now)
+                for message_id in event.deleted_ids
+            )
+        logger.debug("Messages %s in chat %s deleted", event.deleted_ids, chat_id)
+
+
+async def log_cache_stats(cache: EntityCache, interval: float) -> None:
+    """Log the cache's hit/miss counters every ``interval`` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Entity cache stats: %s", cache.stats())
+
+
+async def run_listener(
+    client: TelegramClient,
+    cache: EntityCache,
+    stats_interval: float = CACHE_STATS_INTERVAL,
+) -> None:
+    """Serve the handlers of :func:`attach_listener` until disconnected.
 
+    Cache counters are logged every ``stats_interval`` seconds while the
+    listener runs, and once more when it stops.
+    """
     logger.info("Listening for new messages...")
-    await client.run_until_disconnected()
+    reporter = asyncio.create_task(log_cache_stats(cache, stats_interval))
+    try:
+        await client.run_until_disconnected()
+    finally:
+        reporter.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await reporter
+        logger.info("Entity cache stats: %s", cache.stats())
 
 
 async def select_dialog(dialogs: List[Dialog]) -> Optional[Dialog]:
@@ -98,8 +376,203 @@ async def select_dialog(dialogs: List[Dialog]) -> Optional[Dialog]:
     return None
 
 
-async def main() -> None:
-    db = Database()
+def filter_dialogs(dialogs: Sequence[Dialog], chat_ids: Iterable[int]) -> List[Dialog]:
+    """Keep only dialogs whose id is in ``chat_ids``, warning about the rest."""
+    wanted = set(chat_ids)
+    selected = [dialog for dialog in dialogs if dialog.id in wanted]
+    missing = wanted - {dialog.id for dialog in selected}
+    if missing:
+        logger.warning("Dialogs not found: %s", sorted(missing))
+    return selected
+
+
+async def backfill(args: argparse.Namespace) -> None:
+    """Non-interactive history backfill over many dialogs."""
+    db = Database(args.db)
+    await db.connect()
+    client = TelegramClient(config.session_name, config.api_id, config.api_hash)
+    await client.start()
+    logger.info("Connected to Telegram.")
+    media = await start_media_capture(args, client, db)
+
+    try:
+        dialogs = await list_dialogs(client)
+        if args.chat:
+            dialogs = filter_dialogs(dialogs, args.chat)
+        await run_for_dialogs(
+            dialogs,
+            lambda dialog: backfill_dialog(
+                client,
+                db,
+                dialog,
+                limit=args.limit,
+                batch_size=args.batch_size,
+                media=media,
+                resume=not args.restart,
+            ),
+            concurrency=args.concurrency,
+        )
+    finally:
+        if media is not None:
+            await media.close()
+        await client.disconnect()
+        await db.close()
+
+
+async def sync(args: argparse.Namespace) -> None:
+    """Catch up every tracked chat (plus ``--chat``) from its high-water mark."""
+    db = Database(args.db, write_behind=args.listen)
+    await db.connect()
+    client = TelegramClient(config.session_name, config.api_id, config.api_hash)
+    await client.start()
+    logger.info("Connected to Telegram.")
+    media = await start_media_capture(args, client, db)
+
+    try:
+        tracked = await db.get_sync_state()
+        all_dialogs = await list_dialogs(client)
+        dialogs = filter_dialogs(all_dialogs, [*tracked, *(args.chat or [])])
+        if args.listen:
+            cache = EntityCache()
+            cache.warm(all_dialogs)
+            attach_listener(
+                client, db, cache, media, own_chats=private_chat_ids(all_dialogs)
+            )
+        await run_for_dialogs(
+            dialogs,
+            lambda dialog: sync_dialog(
+                client,
+                db,
+                dialog,
+                initial_limit=args.limit,
+                batch_size=args.batch_size,
+                media=media,
+            ),
+            concurrency=args.concurrency,
+            action="Sync",
+        )
+        if args.listen:
+            await run_listener(client, cache)
+    finally:
+        if media is not None:
+            await media.close()
+        await client.disconnect()
+        await db.close()
+
+
+def add_backfill_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the ``backfill`` command (shared with ``supervisor.py``)."""
+    parser.add_argument(
+        "--chat",
+        type=int,
+        action="append",
+        help="Dialog id to backfill (repeatable). Default: all dialogs.",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Dialogs fetched at once."
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Max messages per dialog."
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="Messages per DB transaction."
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Start from the newest message instead of below the oldest stored one.",
+    )
+
+
+def add_sync_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the ``sync`` command (shared with ``supervisor.py``)."""
+    parser.add_argument(
+        "--chat",
+        type=int,
+        action="append",
+        help="Extra dialog id to start tracking (repeatable).",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Dialogs synced at once."
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=100,
+        help="Messages fetched for a chat that has no high-water mark yet.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="Messages per DB transaction."
+    )
+    parser.add_argument(
+        "--listen", action="store_true", help="Start the live listener afterwards."
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Telethon collector: interactive fetch + live listener by default."
+    )
+    parser.add_argument(
+        "--db",
+        help="Path to messages.db (default: $MESSAGES_DB_PATH or the one next to main.py).",
+    )
+    parser.add_argument(
+        "--media",
+        choices=["off", "meta", "download"],
+        default="off",
+        help="Media capture: off, metadata only, or metadata plus file downloads.",
+    )
+    parser.add_argument(
+        "--media-dir",
+        help="Content-addressed store for downloads (default: media/ next to the DB).",
+    )
+    parser.add_argument(
+        "--media-workers", type=int, default=4, help="Files downloaded at once."
+    )
+    parser.add_argument(
+        "--media-max-mb",
+        type=float,
+        default=None,
+        help="Skip downloading files larger than this (metadata is still saved).",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    add_backfill_arguments(
+        subparsers.add_parser(
+            "backfill", help="Archive history of many dialogs in parallel."
+        )
+    )
+    add_sync_arguments(
+        subparsers.add_parser(
+            "sync", help="Fetch only new messages for every tracked chat."
+        )
+    )
+    return parser
+
+
+async def start_media_capture(
+    args: argparse.Namespace, client: TelegramClient, db: Database
+) -> Optional[MediaCapture]:
+    """Build and start the media capture requested by ``--media`` (or None)."""
+    if args.media == "off":
+        return None
+    store = None
+    if args.media == "download":
+        media_dir = args.media_dir or Path(resolve_db_path(args.db)).parent / "media"
+        store = BlobStore(str(media_dir))
+    max_size = None
+    if args.media_max_mb is not None:
+        max_size = int(args.media_max_mb * 1024 * 1024)
+    media = MediaCapture(
+        client, db, store, workers=args.media_workers, max_size=max_size
+    )
+    await media.start()
+    return media
+
+
+async def main(args: argparse.Namespace) -> None:
+    db = Database(args.db, write_behind=True)
     await db.connect()
     client = TelegramClient(config.session_name, config.api_id, config.api_hash)
 
@@ -114,25 +587,37 @@ async def main() -> None:
         await db.close()
         return
 
+    media = await start_media_capture(args, client, db)
+    cache = EntityCache()
+    cache.warm(dialogs)
+    attach_listener(client, db, cache, media, own_chats=private_chat_ids(dialogs))
     try:
-        logger.info("Fetching last 100 messages from '%s'...", selected_dialog.title)
-        messages = await fetch_recent_messages(client, selected_dialog, limit=100)
-        for msg in messages:
-            await save_message_to_db(db, selected_dialog, msg)
-        logger.info("Fetched and stored %d messages.", len(messages))
+        logger.info("Syncing new messages from '%s'...", selected_dialog.title)
+        count = await sync_dialog(
+            client, db, selected_dialog, initial_limit=100, media=media
+        )
+        logger.info("Fetched and stored %d messages.", count)
     except FloodWaitError as exc:
         logger.error("Rate limited by Telegram. Wait for %s seconds.", exc.seconds)
     except Exception:
         logger.exception("Failed to fetch messages.")
 
-    # Start live listener with automatic reconnection handled by Telethon.
+    # Keep listening, with automatic reconnection handled by Telethon.
     try:
-        await run_listener(client, db)
+        await run_listener(client, cache)
     finally:
+        if media is not None:
+            await media.close()
         await client.disconnect()
         await db.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli_args = build_parser().parse_args()
+    if cli_args.command == "backfill":
+        asyncio.run(backfill(cli_args))
+    elif cli_args.command == "sync":
+        asyncio.run(sync(cli_args))
+    else:
+        asyncio.run(main(cli_args))
 
@@ -0,0 +1,257 @@
+"""Media metadata capture and a content-addressed store for downloads."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.errors.rpcerrorlist import FloodWaitError
+from telethon.tl.custom.message import Message
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from db import Database, MediaRecord
+
+logger = logging.getLogger(__name__)
+
+# Most specific first: a voice note is also a document, a GIF also a video.
+MEDIA_KINDS = (
+    "sticker",
+    "voice",
+    "video_note",
+    "gif",
+    "video",
+    "audio",
+    "photo",
+    "document",
+)
+
+# Telegram serves files in parts of at most 512 KiB.
+DOWNLOAD_REQUEST_SIZE = 512 * 1024
+
+
+def media_kind(message: Message) -> Optional[str]:
+    """Short media type of a message, or ``None`` if it has no media."""
+    if message.media is None:
+        return None
+    # Only attached photos and documents: Message.photo/.document also
+    # return the picture of a web page preview.
+    if isinstance(message.media, (MessageMediaPhoto, MessageMediaDocument)):
+        for kind in MEDIA_KINDS:
+            if getattr(message, kind, None):
+                return kind
+    # Web page previews, polls, locations, contacts...: metadata only.
+    return type(message.media).__name__.replace("MessageMedia", "").lower() or "other"
+
+
+def messages_to_media(chat_id: int, messages: Iterable[Message]) -> List[MediaRecord]:
+    """Media metadata rows for the messages of a batch that carry media."""
+    records = []
+    for message in messages:
+        kind = media_kind(message)
+        if kind is None or message.id is None:
+            continue
+        # A web page preview has no file of the message's own to download.
+        file = message.file if kind in MEDIA_KINDS else None
+        records.append(
+            MediaRecord(
+                chat_id,
+                message.id,
+                kind,
+                getattr(file.media, "id", None) if file else None,
+                file.mime_type if file else None,
+                file.size if file else None,
+                file.name if file else None,
+            )
+        )
+    return records
+
+
+class BlobStore:
+    """Files on disk named by the SHA-256 of their content.
+
+    A blob lives at ``<root>/<first two hex digits>/<sha256>``, so the same
+    content downloaded twice (e.g. a repost with a new file id) takes disk
+    space once. Writes are streamed into a temporary file while hashing and
+    then renamed into place, so memory use does not depend on file size and
+    a crash never leaves a partial blob under a content name. Disk I/O runs
+    in worker threads, off the event loop the listener shares.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+        self._tmp = self.root / "tmp"
+        self._tmp.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def has(self, sha256: str) -> bool:
+        return self.path_for(sha256).exists()
+
+    async def write(self, chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+        """Store streamed content; returns ``(sha256, size)``."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = await asyncio.to_thread(tempfile.mkstemp, dir=self._tmp)
+        try:
+            with os.fdopen(fd, "wb") as f:
+
+                def append(chunk: bytes) -> None:
+                    digest.update(chunk)
+                    f.write(chunk)
+
+                async for chunk in chunks:
+                    await asyncio.to_thread(append, chunk)
+                    size += len(chunk)
+                await asyncio.to_thread(f.flush)
+            sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._place, tmp_path, sha256)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+        return sha256, size
+
+    def _place(self, tmp_path: str, sha256: str) -> None:
+        """Move a finished temporary file to its content name (or drop a duplicate)."""
+        target = self.path_for(sha256)
+        if target.exists():
+            os.unlink(tmp_path)
+        else:
+            target.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, target)
+
+
+class MediaCapture:
+    """Store media metadata for ingested messages and optionally download files.
+
+    Without a ``store`` only metadata is saved. With one, files go through a
+    bounded pool: :meth:`capture` waits while ``workers * 2`` downloads are
+    queued, so a fast backfill cannot pile up messages in memory. A file id
+    that was already downloaded (here or by an earlier run) is linked to the
+    existing blob without downloading it again.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        db: Database,
+        store: Optional[BlobStore] = None,
+        *,
+        workers: int = 4,
+        max_size: Optional[int] = None,
+    ) -> None:
+        self.client = client
+        self.db = db
+        self.store = store
+        self.workers = workers
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue[Tuple[MediaRecord, Message]]] = None
+        self._tasks: List[asyncio.Task[None]] = []
+        self._inflight: Dict[int, asyncio.Future[str]] = {}
+
+    async def start(self) -> None:
+        if self.store is None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.workers * 2)
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def close(self) -> None:
+        """Finish queued downloads and stop the workers."""
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    async def capture(self, chat_id: int, messages: Iterable[Message]) -> None:
+        """Save metadata for a batch and queue downloads of its files."""
+        messages = list(messages)
+        records = messages_to_media(chat_id, messages)
+        if not records:
+            return
+        await self.db.save_media(records)
+        if self._queue is None:
+            return
+        by_id = {message.id: message for message in messages}
+        for record in records:
+            if record.file_id is None:
+                continue
+            if self.max_size is not None and (record.size or 0) > self.max_size:
+                logger.debug(
+                    "Skipping %s of message %s: %s bytes",
+                    record.kind,
+                    record.message_id,
+                    record.size,
+                )
+                continue
+            await self._queue.put((record, by_id[record.message_id]))
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            record, message = await self._queue.get()
+            try:
+                await self._download(record, message)
+            except Exception:
+                logger.exception(
+                    "Failed to download media of message %s in chat %s",
+                    record.message_id,
+                    record.chat_id,
+                )
+            finally:
+                self._queue.task_done()
+
+    async def _download(self, record: MediaRecord, message: Message) -> None:
+        assert self.store is not None and record.file_id is not None
+        pending = self._inflight.get(record.file_id)
+        if pending is not None:
+            sha256 = await pending
+        else:
+            # Registered before the first await, so concurrent reposts of
+            # the same file wait for this download instead of starting one.
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[record.file_id] = future
+            try:
+                sha256 = await self.db.find_blob(record.file_id)
+                if sha256 is None or not self.store.has(sha256):
+                    sha256 = await self._fetch(message)
+                future.set_result(sha256)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as exc:
+                future.set_exception(exc)
+                future.exception()  # consumed here if nobody else waits
+                raise
+            finally:
+                del self._inflight[record.file_id]
+        await self.db.set_media_blob(record.chat_id, record.message_id, sha256)
+
+    async def _fetch(self, message: Message) -> str:
+        assert self.store is not None
+        while True:
+            try:
+                sha256, size = await self.store.write(
+                    self.client.iter_download(
+                        message.file.media, request_size=DOWNLOAD_REQUEST_SIZE
+                    )
+                )
+            except FloodWaitError as exc:
+                logger.warning("Flood wait on download: sleeping %s s", exc.seconds)
+                await asyncio.sleep(exc.seconds + 1)
+                continue
+            logger.debug("Stored %d bytes as %s", size, sha256)
+            return sha256
@@ -0,0 +1,806 @@
+"""Versioned schema migrations for the shared messages database.
+
+The collector (``db.py``), the Flask dashboard and the bot all open the same
+SQLite file, so every one of them runs :func:`migrate` on startup. Each step
+is idempotent and is applied at most once; the applied version is stored in
+the ``schema_version`` table.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+from typing import Callable, List, Tuple
+
+from dbconfig import connect, resolve_db_path
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _primary_key(conn: sqlite3.Connection, table: str) -> List[str]:
+    rows = [row for row in conn.execute(f"PRAGMA table_info({table})") if row[5]]
+    return [row[1] for row in sorted(rows, key=lambda row: row[5])]
+
+
+def _v1_create_messages(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            text TEXT NOT NULL,
+            date TEXT NOT NULL
+        );
+        """
+    )
+
+
+def _v2_add_processed(conn: sqlite3.Connection) -> None:
+    if "processed" not in _columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN processed INTEGER DEFAULT 0")
+
+
+def _v3_composite_key(conn: sqlite3.Connection) -> None:
+    """Re-key messages on (chat_id, id): message ids are only unique per chat."""
+    if _primary_key(conn, "messages") == ["chat_id", "id"]:
+        return
+    conn.execute(
+        """
+        CREATE TABLE messages_v3 (
+            id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            text TEXT NOT NULL,
+            date TEXT NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, id)
+        );
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO messages_v3 (id, chat_id, sender, text, date, processed)
+        SELECT id, chat_id, sender, text, date, COALESCE(processed, 0)
+        FROM messages
+        ORDER BY rowid;
+        """
+    )
+    conn.execute("DROP TABLE messages;")
+    conn.execute("ALTER TABLE messages_v3 RENAME TO messages;")
+
+
+def _v4_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date);")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_id, date);"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_processed ON messages(processed);"
+    )
+
+
+def _v5_sync_state(conn: sqlite3.Connection) -> None:
+    """Per-chat high-water marks for incremental sync, seeded from stored rows."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            chat_id INTEGER PRIMARY KEY,
+            max_message_id INTEGER NOT NULL
+        );
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO sync_state (chat_id, max_message_id)
+        SELECT chat_id, MAX(id) FROM messages GROUP BY chat_id;
+        """
+    )
+
+
+def _v6_stats(conn: sqlite3.Connection) -> None:
+    """Trigger-maintained counters, so stats pages never run COUNT(*)."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_messages INTEGER NOT NULL DEFAULT 0,
+            processed_messages INTEGER NOT NULL DEFAULT 0,
+            latest_date TEXT
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            chat_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            latest_date TEXT
+        );
+        """
+    )
+    # One-time scan to seed the counters from existing rows.
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO stats (id, total_messages, processed_messages, latest_date)
+        SELECT 1, COUNT(*), COALESCE(SUM(processed = 1), 0), MAX(date) FROM messages;
+        """
+    )
+    conn.execute("DELETE FROM chat_stats;")
+    conn.execute(
+        """
+        INSERT INTO chat_stats (chat_id, message_count, latest_date)
+        SELECT chat_id, COUNT(*), MAX(date) FROM messages GROUP BY chat_id;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_stats_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE stats SET
+                total_messages = total_messages + 1,
+                processed_messages = processed_messages + (NEW.processed = 1),
+                latest_date = MAX(COALESCE(latest_date, NEW.date), NEW.date)
+            WHERE id = 1;
+            INSERT INTO chat_stats (chat_id, message_count, latest_date)
+            VALUES (NEW.chat_id, 1, NEW.date)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                message_count = message_count + 1,
+                latest_date = MAX(COALESCE(latest_date, excluded.latest_date),
+                                  excluded.latest_date);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_stats_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE stats SET
+                total_messages = total_messages - 1,
+                processed_messages = processed_messages - (OLD.processed = 1),
+                latest_date = (SELECT MAX(date) FROM messages)
+            WHERE id = 1;
+            UPDATE chat_stats SET
+                message_count = message_count - 1,
+                latest_date = (
+                    SELECT MAX(date) FROM messages WHERE chat_id = OLD.chat_id
+                )
+            WHERE chat_id = OLD.chat_id;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_stats_processed
+        AFTER UPDATE OF processed ON messages
+        WHEN NEW.processed IS NOT OLD.processed
+        BEGIN
+            UPDATE stats SET processed_messages =
+                processed_messages + (NEW.processed = 1) - (OLD.processed = 1)
+            WHERE id = 1;
+        END;
+        """
+    )
+
+
+def _v7_fts(conn: sqlite3.Connection) -> None:
+    """FTS5 index over text and sender, synced with messages by triggers.
+
+    The index starts empty; fill it for existing rows with
+    ``python schema.py rebuild-fts``.
+    """
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text,
+            sender,
+            content='messages',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, text, sender)
+            VALUES (NEW.rowid, NEW.text, NEW.sender);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, sender)
+            VALUES ('delete', OLD.rowid, OLD.text, OLD.sender);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update
+        AFTER UPDATE OF text, sender ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, sender)
+            VALUES ('delete', OLD.rowid, OLD.text, OLD.sender);
+            INSERT INTO messages_fts (rowid, text, sender)
+            VALUES (NEW.rowid, NEW.text, NEW.sender);
+        END;
+        """
+    )
+
+
+def _v8_summary_jobs(conn: sqlite3.Connection) -> None:
+    """Persistent job queue and per-chat digest schedules for the bot.
+
+    Command handlers only insert into ``summary_jobs``; worker threads claim
+    pending rows, so queued work survives a restart.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS summary_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reply_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_summary_jobs_status "
+        "ON summary_jobs(status, id);"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS digest_schedules (
+            chat_id INTEGER PRIMARY KEY,
+            interval_seconds INTEGER NOT NULL,
+            next_run_at REAL NOT NULL
+        );
+        """
+    )
+
+
+def _v9_chat_watermarks(conn: sqlite3.Connection) -> None:
+    """Per-chat "summarized up to id" watermarks replace the processed flag.
+
+    A message counts as processed when its id is at or below its chat's
+    ``last_processed_id``, so marking a backlog done is one upsert and
+    unprocessed rows are a primary-key range scan. The legacy ``processed``
+    column is kept but no longer maintained.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_watermarks (
+            chat_id INTEGER PRIMARY KEY,
+            last_processed_id INTEGER NOT NULL
+        );
+        """
+    )
+    # Seed: everything below the first unprocessed message of each chat.
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO chat_watermarks (chat_id, last_processed_id)
+        SELECT chat_id, COALESCE(MIN(CASE WHEN processed = 0 THEN id END) - 1, MAX(id))
+        FROM messages GROUP BY chat_id;
+        """
+    )
+    conn.execute(
+        """
+        UPDATE stats SET processed_messages = (
+            SELECT COUNT(*) FROM messages AS m
+            JOIN chat_watermarks AS w
+                ON w.chat_id = m.chat_id AND m.id <= w.last_processed_id
+        )
+        WHERE id = 1;
+        """
+    )
+    conn.execute("DROP TRIGGER IF EXISTS messages_stats_processed;")
+    conn.execute("DROP INDEX IF EXISTS idx_messages_processed;")
+
+    # Insert/delete counters now derive "processed" from the watermark.
+    conn.execute("DROP TRIGGER IF EXISTS messages_stats_insert;")
+    conn.execute("DROP TRIGGER IF EXISTS messages_stats_delete;")
+    conn.execute(
+        """
+        CREATE TRIGGER messages_stats_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE stats SET
+                total_messages = total_messages + 1,
+                processed_messages = processed_messages + COALESCE(NEW.id <= (
+                    SELECT last_processed_id FROM chat_watermarks
+                    WHERE chat_id = NEW.chat_id
+                ), 0),
+                latest_date = MAX(COALESCE(latest_date, NEW.date), NEW.date)
+            WHERE id = 1;
+            INSERT INTO chat_stats (chat_id, message_count, latest_date)
+            VALUES (NEW.chat_id, 1, NEW.date)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                message_count = message_count + 1,
+                latest_date = MAX(COALESCE(latest_date, excluded.latest_date),
+                                  excluded.latest_date);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER messages_stats_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE stats SET
+                total_messages = total_messages - 1,
+                processed_messages = processed_messages - COALESCE(OLD.id <= (
+                    SELECT last_processed_id FROM chat_watermarks
+                    WHERE chat_id = OLD.chat_id
+                ), 0),
+                latest_date = (SELECT MAX(date) FROM messages)
+            WHERE id = 1;
+            UPDATE chat_stats SET
+                message_count = message_count - 1,
+                latest_date = (
+                    SELECT MAX(date) FROM messages WHERE chat_id = OLD.chat_id
+                )
+            WHERE chat_id = OLD.chat_id;
+        END;
+        """
+    )
+    # Moving a watermark counts only the rows it passes (a PK range count).
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_watermarks_stats_insert
+        AFTER INSERT ON chat_watermarks
+        BEGIN
+            UPDATE stats SET processed_messages = processed_messages + (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = NEW.chat_id AND id <= NEW.last_processed_id
+            )
+            WHERE id = 1;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_watermarks_stats_update
+        AFTER UPDATE OF last_processed_id ON chat_watermarks
+        WHEN NEW.last_processed_id IS NOT OLD.last_processed_id
+        BEGIN
+            UPDATE stats SET processed_messages = processed_messages + (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = NEW.chat_id
+                  AND id > OLD.last_processed_id AND id <= NEW.last_processed_id
+            ) - (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = NEW.chat_id
+                  AND id > NEW.last_processed_id AND id <= OLD.last_processed_id
+            )
+            WHERE id = 1;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_watermarks_stats_delete
+        AFTER DELETE ON chat_watermarks
+        BEGIN
+            UPDATE stats SET processed_messages = processed_messages - (
+                SELECT COUNT(*) FROM messages
+                WHERE chat_id = OLD.chat_id AND id <= OLD.last_processed_id
+            )
+            WHERE id = 1;
+        END;
+        """
+    )
+
+
+# UTC offset of the host the bot ran on (e.g. "+03:00"), for migration 10.
+LEGACY_DATES_OFFSET_ENV = "LEGACY_DATES_UTC_OFFSET"
+
+
+def _naive_date_modifier() -> str:
+    """SQLite date modifier turning a legacy naive date into UTC.
+
+    Old bot versions wrote ``datetime.fromtimestamp(...)``: naive local
+    time of the bot's host. By default that is assumed to be this host's
+    timezone (``'utc'`` modifier); ``$LEGACY_DATES_UTC_OFFSET`` overrides it.
+    """
+    offset = os.getenv(LEGACY_DATES_OFFSET_ENV)
+    if not offset:
+        return "utc"
+    sign = -1 if offset.startswith("-") else 1
+    hours, _, minutes = offset.lstrip("+-").partition(":")
+    return f"{-sign * (int(hours) * 60 + int(minutes or 0))} minutes"
+
+
+def _v10_epoch_dates(conn: sqlite3.Connection) -> None:
+    """Store message dates as integer epoch seconds in ``ts``.
+
+    ``date`` becomes a virtual generated column that formats ``ts`` as the
+    same ISO-8601 UTC text Telethon wrote, so existing readers, indexes and
+    triggers keep working while each row stores an integer instead of a
+    25-byte string. Rowids are preserved, so the FTS index stays valid.
+    Legacy naive dates (written by old bot versions in local time) are
+    converted to UTC, see :func:`_naive_date_modifier`; values that are not
+    ISO dates become 0.
+    """
+    if "ts" in _columns(conn, "messages"):
+        return
+    # Indexes and triggers are dropped with the table; recreate them as-is.
+    dependents = [
+        sql
+        for (sql,) in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = 'messages' "
+            "AND type IN ('index', 'trigger') AND sql IS NOT NULL;"
+        )
+    ]
+    conn.execute(
+        """
+        CREATE TABLE messages_v10 (
+            id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            text TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            date TEXT GENERATED ALWAYS AS (
+                strftime('%Y-%m-%dT%H:%M:%S+00:00', ts, 'unixepoch')
+            ) VIRTUAL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, id)
+        );
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO messages_v10 (rowid, id, chat_id, sender, text, ts, processed)
+        SELECT rowid, id, chat_id, sender, text,
+               CASE WHEN date NOT GLOB '[0-9][0-9][0-9][0-9]-*' THEN 0
+                    WHEN date GLOB '*[+-][0-9][0-9]:[0-9][0-9]' OR date GLOB '*Z'
+                    THEN COALESCE(CAST(strftime('%s', date) AS INTEGER), 0)
+                    ELSE COALESCE(CAST(strftime('%s', date, ?) AS INTEGER), 0) END,
+               COALESCE(processed, 0)
+        FROM messages
+        ORDER BY rowid;
+        """,
+        (_naive_date_modifier(),),
+    )
+    conn.execute("DROP TABLE messages;")
+    # chat_watermarks triggers name "messages" and would fail the modern
+    # rename's schema check while the table is missing.
+    conn.execute("PRAGMA legacy_alter_table = ON;")
+    conn.execute("ALTER TABLE messages_v10 RENAME TO messages;")
+    conn.execute("PRAGMA legacy_alter_table = OFF;")
+    for sql in dependents:
+        conn.execute(sql)
+    # Old values mixed offsets and naive local times; re-derive the maxima.
+    conn.execute("UPDATE stats SET latest_date = (SELECT MAX(date) FROM messages);")
+    conn.execute(
+        """
+        UPDATE chat_stats SET latest_date = (
+            SELECT MAX(date) FROM messages WHERE chat_id = chat_stats.chat_id
+        );
+        """
+    )
+
+
+def _v11_ts_indexes(conn: sqlite3.Connection) -> None:
+    """Index ``ts`` instead of the generated ``date`` text.
+
+    Readers sort and filter by the integer ``ts``, so the ``date`` indexes
+    (which materialize the ISO text) are replaced by smaller ``ts`` ones.
+    The delete trigger finds the new latest message along them too.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages(chat_id, ts);"
+    )
+    conn.execute("DROP INDEX IF EXISTS idx_messages_date;")
+    conn.execute("DROP INDEX IF EXISTS idx_messages_chat_date;")
+    conn.execute("DROP TRIGGER IF EXISTS messages_stats_delete;")
+    conn.execute(
+        """
+        CREATE TRIGGER messages_stats_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE stats SET
+                total_messages = total_messages - 1,
+                processed_messages = processed_messages - COALESCE(OLD.id <= (
+                    SELECT last_processed_id FROM chat_watermarks
+                    WHERE chat_id = OLD.chat_id
+                ), 0),
+                latest_date = (SELECT date FROM messages ORDER BY ts DESC LIMIT 1)
+            WHERE id = 1;
+            UPDATE chat_stats SET
+                message_count = message_count - 1,
+                latest_date = (
+                    SELECT date FROM messages WHERE chat_id = OLD.chat_id
+                    ORDER BY ts DESC LIMIT 1
+                )
+            WHERE chat_id = OLD.chat_id;
+        END;
+        """
+    )
+
+
+def _v12_message_media(conn: sqlite3.Connection) -> None:
+    """Media metadata per message, and where its downloaded content lives.
+
+    ``file_id`` is Telegram's photo/document id, which reposts and forwards
+    share, so a file is downloaded once and later rows reuse its
+    ``sha256`` (the blob's name in the content-addressed store).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_media (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_id INTEGER,
+            mime_type TEXT,
+            size INTEGER,
+            file_name TEXT,
+            sha256 TEXT,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_media_file "
+        "ON message_media(file_id);"
+    )
+
+
+def _v13_revisions(conn: sqlite3.Connection) -> None:
+    """Edit history and deletion tombstones for messages.
+
+    ``messages.text`` stays the text first seen; every later change is a
+    row in ``message_revisions`` numbered from 1, so the current text is a
+    single primary-key probe for the highest revision. A tombstone is keyed
+    by the chat that stores the message, like the message itself.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_revisions (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            edited_ts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id, revision)
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_tombstones (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            deleted_ts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        """
+    )
+
+
+def _v14_backfill_state(conn: sqlite3.Connection) -> None:
+    """Oldest message id stored by each chat's history backfill.
+
+    Backfill walks from the newest message to the oldest, so an
+    interrupted run resumes below this id instead of starting over.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backfill_state (
+            chat_id INTEGER PRIMARY KEY,
+            oldest_message_id INTEGER NOT NULL
+        );
+        """
+    )
+
+
+# Current text of messages row ``{row}``: its latest revision, else the text
+# first seen.
+_CURRENT_TEXT = """COALESCE((
+    SELECT text FROM message_revisions
+    WHERE chat_id = {row}.chat_id AND message_id = {row}.id
+    ORDER BY revision DESC LIMIT 1
+), {row}.text)"""
+
+
+def _v15_fts_current_text(conn: sqlite3.Connection) -> None:
+    """Index the current (edited) text in ``messages_fts`` instead of the first one.
+
+    The index gets ``messages_current`` as its external content, so
+    ``snippet()`` and ``rebuild`` see the latest revision as well. A new
+    revision replaces the indexed text of its message by trigger. The
+    index is rebuilt once here, so its contents match the triggers.
+    """
+    conn.execute(
+        f"""
+        CREATE VIEW IF NOT EXISTS messages_current AS
+        SELECT m.rowid AS message_rowid, {_CURRENT_TEXT.format(row="m")} AS text,
+               m.sender AS sender
+        FROM messages AS m;
+        """
+    )
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+    conn.execute("DROP TABLE IF EXISTS messages_fts;")
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            text,
+            sender,
+            content='messages_current',
+            content_rowid='message_rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, text, sender)
+            VALUES (NEW.rowid, {_CURRENT_TEXT.format(row="NEW")}, NEW.sender);
+        END;
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, sender)
+            VALUES ('delete', OLD.rowid, {_CURRENT_TEXT.format(row="OLD")}, OLD.sender);
+        END;
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER messages_fts_update
+        AFTER UPDATE OF text, sender ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, sender)
+            VALUES ('delete', OLD.rowid, {_CURRENT_TEXT.format(row="OLD")}, OLD.sender);
+            INSERT INTO messages_fts (rowid, text, sender)
+            VALUES (NEW.rowid, {_CURRENT_TEXT.format(row="NEW")}, NEW.sender);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER messages_fts_revision AFTER INSERT ON message_revisions
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, sender)
+            SELECT 'delete', m.rowid, COALESCE((
+                SELECT text FROM message_revisions
+                WHERE chat_id = NEW.chat_id AND message_id = NEW.message_id
+                  AND revision < NEW.revision
+                ORDER BY revision DESC LIMIT 1
+            ), m.text), m.sender
+            FROM messages AS m
+            WHERE m.chat_id = NEW.chat_id AND m.id = NEW.message_id;
+            INSERT INTO messages_fts (rowid, text, sender)
+            SELECT m.rowid, NEW.text, m.sender
+            FROM messages AS m
+            WHERE m.chat_id = NEW.chat_id AND m.id = NEW.message_id;
+        END;
+        """
+    )
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');")
+
+
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _v1_create_messages),
+    (2, _v2_add_processed),
+    (3, _v3_composite_key),
+    (4, _v4_indexes),
+    (5, _v5_sync_state),
+    (6, _v6_stats),
+    (7, _v7_fts),
+    (8, _v8_summary_jobs),
+    (9, _v9_chat_watermarks),
+    (10, _v10_epoch_dates),
+    (11, _v11_ts_indexes),
+    (12, _v12_message_media),
+    (13, _v13_revisions),
+    (14, _v14_backfill_state),
+    (15, _v15_fts_current_text),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    """Return the schema version recorded in the database (0 if none)."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);"
+    )
+    row = conn.execute("SELECT MAX(version) FROM schema_version;").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Bring the database up to :data:`SCHEMA_VERSION`.
+
+    An up-to-date database costs a single read. Otherwise all pending steps
+    run in one ``BEGIN IMMEDIATE`` transaction and the version is re-read
+    inside it, so two processes starting at the same time cannot apply a
+    step twice.
+
+    Returns:
+        The schema version after migration.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    if get_version(conn) >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        version = get_version(conn)
+        for step_version, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            step(conn)
+            conn.execute("DELETE FROM schema_version;")
+            conn.execute(
+                "INSERT INTO schema_version (version) VALUES (?);", (step_version,)
+            )
+            version = step_version
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return version
+
+
+def migrate_path(path: str) -> int:
+    """Open ``path``, run :func:`migrate` and close the connection."""
+    conn = connect(path)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+def rebuild_fts(conn: sqlite3.Connection) -> int:
+    """Re-index the current text of every row of ``messages`` in ``messages_fts``.
+
+    Migration 15 already does this once; safe to repeat at any time. Returns the number of indexed rows.
+    """
+    migrate(conn)
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');")
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM messages;").fetchone()[0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain the messages database.")
+    parser.add_argument(
+        "command",
+        choices=["migrate", "rebuild-fts"],
+        help="migrate: apply pending migrations; rebuild-fts: backfill search index.",
+    )
+    parser.add_argument(
+        "--db", help="Path to messages.db (default: $MESSAGES_DB_PATH or the collector's one)."
+    )
+    args = parser.parse_args()
+
+    conn = connect(resolve_db_path(args.db))
+    try:
+        if args.command == "migrate":
+            print(f"Schema version: {migrate(conn)}")
+        else:
+            print(f"Indexed {rebuild_fts(conn)} messages.")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
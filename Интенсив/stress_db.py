@@ -0,0 +1,265 @@
+"""Multi-process stress test for shared access to the messages database.
+
+Runs the collector's async writer, the bot's writer and dashboard-style
+read-only readers as separate processes against one SQLite file for a fixed
+time, then reports throughput, worst latency and every "database is locked"
+error. Exits with status 1 if any operation failed or stalled.
+
+    python stress_db.py --duration 20 --collectors 2 --bots 1 --readers 4
+
+Without ``--db`` a throwaway database in a temporary directory is used;
+never point it at a database you care about, it inserts synthetic rows.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from db import Database, MessageRecord
+from dbconfig import connect
+from schema import migrate
+
+BOT_DIR = Path(__file__).resolve().parent.parent / "Бот"
+
+
+@dataclass
+class Report:
+    """What one worker process did."""
+
+    name: str
+    ops: int = 0
+    rows: int = 0
+    max_ms: float = 0.0
+    stalls: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+class _Timer:
+    """Time operations of one worker and record failures instead of raising."""
+
+    def __init__(self, report: Report, stall_ms: float) -> None:
+        self.report = report
+        self.stall_ms = stall_ms
+
+    def run(self, op: Callable[[], int]) -> None:
+        started = time.perf_counter()
+        try:
+            rows = op()
+        except sqlite3.Error as exc:
+            self.report.errors.append(f"{type(exc).__name__}: {exc}")
+            return
+        self.record(started, rows)
+
+    def record(self, started: float, rows: int) -> None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.report.ops += 1
+        self.report.rows += rows
+        self.report.max_ms = max(self.report.max_ms, elapsed_ms)
+        if elapsed_ms > self.stall_ms:
+            self.report.stalls += 1
+
+
+async def _collector(
+    path: str, worker: int, deadline: float, batch: int, stall_ms: float
+) -> Report:
+    report = Report(f"collector-{worker}")
+    timer = _Timer(report, stall_ms)
+    db = Database(path)
+    await db.connect()
+    chat_id = -1_000_000 - worker
+    next_id = 1
+    try:
+        while time.time() < deadline:
+            now = int(time.time())
+            records = [
+                MessageRecord(
+                    next_id + i, chat_id, "stress", f"collector {worker} #{next_id + i}", now
+                )
+                for i in range(batch)
+            ]
+            next_id += batch
+            started = time.perf_counter()
+            try:
+                rows = await db.save_messages(records)
+            except sqlite3.Error as exc:
+                report.errors.append(f"{type(exc).__name__}: {exc}")
+                continue
+            timer.record(started, rows)
+    finally:
+        await db.close()
+    return report
+
+
+def collector_worker(
+    path: str, worker: int, deadline: float, batch: int, stall_ms: float, out
+) -> None:
+    out.put(asyncio.run(_collector(path, worker, deadline, batch, stall_ms)))
+
+
+def bot_worker(
+    path: str, worker: int, deadline: float, batch: int, stall_ms: float, out
+) -> None:
+    """Imitate the bot: incoming messages, summary jobs and /stats."""
+    sys.path.append(str(BOT_DIR))
+    from database import Database as BotDatabase
+
+    report = Report(f"bot-{worker}")
+    timer = _Timer(report, stall_ms)
+    db = BotDatabase(path)
+    chat_id = -2_000_000 - worker
+    next_id = 1
+    try:
+        while time.time() < deadline:
+            now = int(time.time())
+            rows = [
+                (next_id + i, chat_id, "stress", f"bot {worker} #{next_id + i}", now)
+                for i in range(batch)
+            ]
+            next_id += batch
+            timer.run(lambda: db.save_messages(rows))
+
+            def summarize_job() -> int:
+                db.enqueue_job(chat_id, "summarize")
+                job = db.claim_next_job()
+                if job is not None:
+                    db.mark_processed_up_to(chat_id, next_id - 1)
+                    db.finish_job(job["id"])
+                return 0
+
+            timer.run(summarize_job)
+            timer.run(lambda: len(db.get_stats(chat_id)))
+    finally:
+        db.close()
+    out.put(report)
+
+
+def reader_worker(
+    path: str, worker: int, deadline: float, batch: int, stall_ms: float, out
+) -> None:
+    """Imitate dashboard requests over a read-only connection."""
+    report = Report(f"reader-{worker}")
+    timer = _Timer(report, stall_ms)
+    conn = connect(path, readonly=True)
+    queries = [
+        ("SELECT total_messages, processed_messages, latest_date FROM stats", ()),
+        ("SELECT chat_id, message_count FROM chat_stats ORDER BY message_count DESC", ()),
+        (
+            "SELECT id, sender, text, ts FROM messages "
+            "WHERE chat_id = ? ORDER BY ts DESC LIMIT ?",
+            (-1_000_000, batch),
+        ),
+        (
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?",
+            ("collector", batch),
+        ),
+    ]
+    try:
+        while time.time() < deadline:
+            for sql, params in queries:
+                timer.run(lambda: len(conn.execute(sql, params).fetchall()))
+    finally:
+        conn.close()
+    out.put(report)
+
+
+def run(
+    path: str,
+    *,
+    collectors: int,
+    bots: int,
+    readers: int,
+    duration: float,
+    batch: int,
+    stall_ms: float,
+) -> List[Report]:
+    """Run all workers for ``duration`` seconds and collect their reports."""
+    conn = connect(path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    deadline = time.time() + duration
+    plan = (
+        [(collector_worker, i) for i in range(collectors)]
+        + [(bot_worker, i) for i in range(bots)]
+        + [(reader_worker, i) for i in range(readers)]
+    )
+    processes = [
+        ctx.Process(target=target, args=(path, i, deadline, batch, stall_ms, out))
+        for target, i in plan
+    ]
+    for process in processes:
+        process.start()
+    reports = [out.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Hammer one messages database from many processes at once."
+    )
+    parser.add_argument(
+        "--db", help="Database to use (default: a new one in a temporary directory)."
+    )
+    parser.add_argument("--collectors", type=int, default=2, help="Collector writers.")
+    parser.add_argument("--bots", type=int, default=1, help="Bot writers.")
+    parser.add_argument("--readers", type=int, default=4, help="Dashboard readers.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run.")
+    parser.add_argument("--batch", type=int, default=200, help="Rows per write.")
+    parser.add_argument(
+        "--stall-ms",
+        type=float,
+        default=2000.0,
+        help="An operation slower than this counts as a stall.",
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    tmpdir = None if args.db else tempfile.mkdtemp(prefix="stress_db_")
+    path = args.db or str(Path(tmpdir) / "messages.db")
+    try:
+        reports = run(
+            path,
+            collectors=args.collectors,
+            bots=args.bots,
+            readers=args.readers,
+            duration=args.duration,
+            batch=args.batch,
+            stall_ms=args.stall_ms,
+        )
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print(f"{'worker':<14}{'ops':>8}{'rows':>10}{'max ms':>10}{'stalls':>8}{'errors':>8}")
+    for report in sorted(reports, key=lambda r: r.name):
+        print(
+            f"{report.name:<14}{report.ops:>8}{report.rows:>10}"
+            f"{report.max_ms:>10.1f}{report.stalls:>8}{len(report.errors):>8}"
+        )
+        for error in sorted(set(report.errors)):
+            print(f"    {error}")
+    failed = any(report.errors or report.stalls for report in reports)
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,486 @@
+"""Run one collector process per Telegram account over sharded chats.
+
+A single account is throttled with ``FloodWaitError`` long before it has
+read every chat of a large archive. The supervisor starts one process per
+session, splits the chats between them and writes everything they fetch
+through one connection, so adding accounts (and cores) adds ingest
+capacity without adding SQLite writers:
+
+    python supervisor.py --session acc1 --session acc2 login
+    python supervisor.py --session acc1 --session acc2 backfill --limit 50000
+    python supervisor.py --session acc1 --session acc2 --shards shards.json sync --listen
+
+1. Every worker connects with its session and reports the dialogs its
+   account can see.
+2. Each wanted chat goes to exactly one account that sees it: the one
+   named in ``--shards`` (a JSON object ``{"chat_id": "session"}``) or,
+   for other chats, the one chosen by rendezvous hashing, so adding a
+   session only moves the chats it takes over.
+3. Workers run the usual ``backfill``/``sync`` (and listener) code on
+   their chats, but their database is a :class:`QueueSink`: records go
+   over a bounded queue to the supervisor, which commits them in batches.
+4. A worker that dies is restarted with exponential backoff and gets the
+   same chats back; ``backfill`` resumes below the oldest message each
+   chat's backfill stored, ``sync`` from the high-water marks.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import queue
+import sys
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Set
+
+from telethon import TelegramClient
+
+import config
+from db import (
+    BackfillRecord,
+    Database,
+    DeletionRecord,
+    EditRecord,
+    MessageRecord,
+    PrivateDeletionRecord,
+)
+from dbconfig import connect
+from entity_cache import EntityCache
+from main import (
+    add_backfill_arguments,
+    add_sync_arguments,
+    backfill_dialog,
+    attach_listener,
+    list_dialogs,
+    run_for_dialogs,
+    run_listener,
+    sync_dialog,
+)
+
+logger = logging.getLogger("supervisor")
+
+# A worker exiting with this code is not restarted (e.g. session not logged in).
+EXIT_FATAL = 2
+
+# A worker that ran this long before crashing starts its backoff over.
+STABLE_UPTIME_SECONDS = 300.0
+
+
+def pick_session(
+    chat_id: int, candidates: Sequence[str], mapping: Mapping[int, str]
+) -> Optional[str]:
+    """Session that should collect ``chat_id``, among those that can see it.
+
+    The ``mapping`` wins if its session is a candidate; otherwise the
+    candidate with the highest CRC32 of ``"<chat_id>:<session>"`` is
+    chosen (rendezvous hashing), which is stable across runs and machines.
+    """
+    if not candidates:
+        return None
+    mapped = mapping.get(chat_id)
+    if mapped is not None:
+        if mapped in candidates:
+            return mapped
+        logger.warning("Chat %s is mapped to %s, which cannot see it", chat_id, mapped)
+    return max(candidates, key=lambda session: zlib.crc32(f"{chat_id}:{session}".encode()))
+
+
+def assign_chats(
+    visible: Mapping[str, Iterable[int]],
+    mapping: Mapping[int, str],
+    wanted: Optional[Set[int]] = None,
+) -> Dict[str, List[int]]:
+    """Split chats between sessions: ``{session: [chat_id, ...]}``.
+
+    ``visible`` lists the dialogs of each session. Only ``wanted`` chats
+    are assigned (all visible ones if ``None``); wanted chats that no
+    session can see are logged and left out.
+    """
+    seen_by: Dict[int, List[str]] = {}
+    for session, chat_ids in visible.items():
+        for chat_id in chat_ids:
+            seen_by.setdefault(chat_id, []).append(session)
+    shards: Dict[str, List[int]] = {session: [] for session in visible}
+    for chat_id in sorted(seen_by if wanted is None else wanted):
+        session = pick_session(chat_id, seen_by.get(chat_id, []), mapping)
+        if session is None:
+            logger.warning("No session can see chat %s", chat_id)
+            continue
+        shards[session].append(chat_id)
+    return shards
+
+
+def load_shard_map(path: Optional[str]) -> Dict[int, str]:
+    """Read ``{"chat_id": "session"}`` from a JSON file (empty without one)."""
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {int(chat_id): session for chat_id, session in json.load(f).items()}
+
+
+class QueueSink:
+    """Stand-in for :class:`db.Database` inside a worker process.
+
+    Writes become ``("write", kind, records)`` items on the supervisor's
+    queue; a full queue blocks the worker, so a slow disk throttles the
+    fetchers instead of growing memory. High-water marks are read through
+    a read-only connection of the worker's own.
+    """
+
+    def __init__(self, out: Any, path: Optional[str] = None) -> None:
+        self.out = out
+        self._conn = connect(path, readonly=True)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    async def save_messages(self, records: Iterable[MessageRecord]) -> int:
+        records = list(records)
+        await self._send("fetched", records)
+        return len(records)
+
+    async def save_message(self, record: MessageRecord) -> bool:
+        await self._send("message", [record])
+        return True
+
+    async def save_edit(self, record: EditRecord) -> None:
+        await self._send("edit", [record])
+
+    async def save_deletions(self, records: Iterable[DeletionRecord]) -> None:
+        await self._send("delete", list(records))
+
+    async def save_private_deletions(
+        self, records: Iterable[PrivateDeletionRecord]
+    ) -> None:
+        await self._send("delete_private", list(records))
+
+    async def save_backfill_progress(self, record: BackfillRecord) -> None:
+        await self._send("backfill", [record])
+
+    async def get_high_water(self, chat_id: int) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT max_message_id FROM sync_state WHERE chat_id = ?;", (chat_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def get_backfill_offset(self, chat_id: int) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT oldest_message_id FROM backfill_state WHERE chat_id = ?;",
+            (chat_id,),
+        ).fetchone()
+        return row[0] if row else None
+
+    async def _send(self, kind: str, records: List[Any]) -> None:
+        if records:
+            await asyncio.to_thread(self.out.put, ("write", kind, records))
+
+
+async def _collect(
+    session: str, args: argparse.Namespace, out: Any, inbox: Any
+) -> None:
+    client = TelegramClient(session, config.api_id, config.api_hash)
+    await client.connect()
+    if not await client.is_user_authorized():
+        logger.error("Session %s is not logged in: run the login command", session)
+        await client.disconnect()
+        sys.exit(EXIT_FATAL)
+    sink = QueueSink(out, args.db)
+    try:
+        dialogs = await list_dialogs(client)
+        await asyncio.to_thread(
+            out.put, ("dialogs", session, [dialog.id for dialog in dialogs])
+        )
+        chats = set(await asyncio.to_thread(inbox.get))
+        mine = [dialog for dialog in dialogs if dialog.id in chats]
+        logger.info("Session %s collects %d chats", session, len(mine))
+        if args.command == "backfill":
+            await run_for_dialogs(
+                mine,
+                lambda dialog: backfill_dialog(
+                    client,
+                    sink,
+                    dialog,
+                    limit=args.limit,
+                    batch_size=args.batch_size,
+                    resume=not args.restart,
+                ),
+                concurrency=args.concurrency,
+            )
+        else:
+            if args.listen:
+                cache = EntityCache()
+                cache.warm(dialogs)
+                attach_listener(client, sink, cache, chats=sorted(chats))
+            await run_for_dialogs(
+                mine,
+                lambda dialog: sync_dialog(
+                    client,
+                    sink,
+                    dialog,
+                    initial_limit=args.limit,
+                    batch_size=args.batch_size,
+                ),
+                concurrency=args.concurrency,
+                action="Sync",
+            )
+            if args.listen:
+                await run_listener(client, cache)
+    finally:
+        sink.close()
+        await client.disconnect()
+
+
+def collector_worker(session: str, args: argparse.Namespace, out: Any, inbox: Any) -> None:
+    """Process entry point: collect the chats the supervisor assigns."""
+    asyncio.run(_collect(session, args, out, inbox))
+
+
+@dataclass
+class Worker:
+    """Supervisor-side state of one session's process."""
+
+    session: str
+    process: Optional[mp.process.BaseProcess] = None
+    inbox: Any = None
+    started_at: float = 0.0
+    restarts: int = 0
+    restart_at: Optional[float] = None
+    finished: bool = False
+
+
+class Supervisor:
+    """Start, feed and restart workers; commit what they send.
+
+    The supervisor is the only writer to the database: batches of
+    ``(kind, record)`` operations from all workers are committed with
+    :meth:`db.Database.apply`, one transaction per batch.
+    """
+
+    target = staticmethod(collector_worker)
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        sessions: Sequence[str],
+        *,
+        mapping: Optional[Mapping[int, str]] = None,
+        wanted: Optional[Set[int]] = None,
+        max_restarts: int = 10,
+        queue_size: int = 256,
+        batch_size: int = 2000,
+    ) -> None:
+        self.args = args
+        self.mapping = dict(mapping or {})
+        self.wanted = wanted
+        self.max_restarts = max_restarts
+        self.batch_size = batch_size
+        self._ctx = mp.get_context("spawn")
+        self._out = self._ctx.Queue(maxsize=queue_size)
+        self.workers = {session: Worker(session) for session in sessions}
+        self.visible: Dict[str, List[int]] = {}
+        self.shards: Optional[Dict[str, List[int]]] = None
+        self.written = 0
+
+    async def run(self, db: Database) -> None:
+        """Run until every worker has finished or given up."""
+        for worker in self.workers.values():
+            self._start(worker)
+        try:
+            while not all(worker.finished for worker in self.workers.values()):
+                await self._pump(db)
+                self._check_workers()
+            # Workers have exited, so everything they sent is in the queue.
+            while await self._pump(db, timeout=0.1):
+                pass
+        finally:
+            for worker in self.workers.values():
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+        logger.info("Supervisor done: %d new messages", self.written)
+
+    def _start(self, worker: Worker) -> None:
+        worker.inbox = self._ctx.Queue()
+        if self.shards is not None:
+            # A restarted worker keeps its chats once they were assigned.
+            worker.inbox.put(self.shards.get(worker.session, []))
+        worker.process = self._ctx.Process(
+            target=self.target,
+            args=(worker.session, self.args, self._out, worker.inbox),
+            name=f"collector-{worker.session}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+
+    async def _pump(self, db: Database, timeout: float = 0.5) -> int:
+        """Take a batch of items from the workers and handle it."""
+        items = await asyncio.to_thread(self._take, timeout)
+        ops = []
+        for item in items:
+            if item[0] == "write":
+                _, kind, records = item
+                ops.extend((kind, record) for record in records)
+            else:
+                _, session, chat_ids = item
+                if self.shards is None:
+                    self.visible[session] = chat_ids
+                    self._maybe_assign()
+        if ops:
+            self.written += await db.apply(ops)
+        return len(items)
+
+    def _take(self, timeout: float) -> List[Any]:
+        try:
+            items = [self._out.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._out.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _maybe_assign(self) -> None:
+        """Assign chats once every live worker has reported its dialogs."""
+        waiting = [
+            worker.session
+            for worker in self.workers.values()
+            if not worker.finished and worker.session not in self.visible
+        ]
+        if waiting:
+            return
+        self.shards = assign_chats(self.visible, self.mapping, self.wanted)
+        for session_name, chats in self.shards.items():
+            logger.info("Session %s: %d chats", session_name, len(chats))
+            self.workers[session_name].inbox.put(chats)
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.finished:
+                continue
+            process = worker.process
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start(worker)
+                continue
+            if process is None or process.is_alive():
+                continue
+            process.join()
+            if process.exitcode == 0:
+                logger.info("Worker %s finished", worker.session)
+                worker.finished = True
+            elif process.exitcode == EXIT_FATAL or worker.restarts >= self.max_restarts:
+                logger.error(
+                    "Worker %s failed (exit code %s), giving up",
+                    worker.session,
+                    process.exitcode,
+                )
+                self._give_up(worker)
+            else:
+                if now - worker.started_at >= STABLE_UPTIME_SECONDS:
+                    worker.restarts = 0
+                delay = min(60, 2**worker.restarts)
+                worker.restarts += 1
+                worker.restart_at = now + delay
+                logger.warning(
+                    "Worker %s died (exit code %s), restarting in %s s",
+                    worker.session,
+                    process.exitcode,
+                    delay,
+                )
+
+    def _give_up(self, worker: Worker) -> None:
+        worker.finished = True
+        if self.shards is None:
+            # The others may only be waiting for this worker's dialogs.
+            self._maybe_assign()
+        elif self.shards.get(worker.session):
+            logger.error(
+                "Chats of %s are not collected: %s",
+                worker.session,
+                self.shards[worker.session],
+            )
+
+
+async def login(sessions: Sequence[str]) -> None:
+    """Log every session in interactively (workers cannot ask for a code)."""
+    for session in sessions:
+        client = TelegramClient(session, config.api_id, config.api_hash)
+        await client.start()
+        me = await client.get_me()
+        logger.info("Session %s: logged in as %s", session, me.username or me.id)
+        await client.disconnect()
+
+
+async def supervise(args: argparse.Namespace) -> None:
+    sessions = args.session or [config.session_name]
+    db = Database(args.db)
+    await db.connect()
+    try:
+        wanted: Optional[Set[int]] = set(args.chat) if args.chat else None
+        if args.command == "sync":
+            wanted = set(await db.get_sync_state()) | (wanted or set())
+        supervisor = Supervisor(
+            args,
+            sessions,
+            mapping=load_shard_map(args.shards),
+            wanted=wanted,
+            max_restarts=args.max_restarts,
+        )
+        await supervisor.run(db)
+    finally:
+        await db.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Collect with several Telegram accounts, one process each."
+    )
+    parser.add_argument(
+        "--session",
+        action="append",
+        help="Telethon session name (repeatable). Default: config.session_name.",
+    )
+    parser.add_argument(
+        "--db",
+        help="Path to messages.db (default: $MESSAGES_DB_PATH or the one next to main.py).",
+    )
+    parser.add_argument(
+        "--shards",
+        help='JSON file {"chat_id": "session"}; other chats are assigned by hash.',
+    )
+    parser.add_argument(
+        "--max-restarts",
+        type=int,
+        default=10,
+        help="Restarts of a crashing worker before its chats are given up.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("login", help="Log every session in interactively.")
+    add_backfill_arguments(
+        subparsers.add_parser(
+            "backfill", help="Archive history of all chats, split between sessions."
+        )
+    )
+    add_sync_arguments(
+        subparsers.add_parser(
+            "sync", help="Fetch new messages of tracked chats, split between sessions."
+        )
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    cli_args = build_parser().parse_args()
+    if cli_args.command == "login":
+        asyncio.run(login(cli_args.session or [config.session_name]))
+    else:
+        asyncio.run(supervise(cli_args))